@@ -6,7 +6,6 @@ Description" This program connects to the Kentik API and pulls the most recent a
 '''
 
 # IMPORTED MODULES
-import requests
 import json
 import datetime
 from time import strftime, gmtime
@@ -14,8 +13,13 @@ from datetime import timedelta
 import modules.auth as auth
 import modules.inputs as inputs
 import modules.outputs as outputs
+import os
 import sys
 
+# Make the shared kentik_common package at the repository root importable.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from kentik_common.client import KentikClient
+
 def main():
     print('Main function')
     seconds_back = inputs.startTime()
@@ -40,14 +44,8 @@ def main():
     print(url)
     print('---------------')
 
-    payload = ""
-    headers = {
-    'X-CH-Auth-Email': auth.username,
-    'X-CH-Auth-API-Token': auth.apikey,
-    'Content-Type': 'application/json'
-    }
-
-    response = requests.request("GET", url, headers=headers, data=payload)
+    with KentikClient(auth.username, auth.apikey) as client:
+        response = client.get(url)
 
     if response.status_code != 200:
         print(f'ERROR - Status Code: {response.status_code}')
@@ -0,0 +1,226 @@
+import argparse
+import collections
+import heapq
+import os
+import re
+import string
+import sys
+import requests
+
+# Make the shared kentik_common package at the repository root importable.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from kentik_common.client import KentikClient
+from kentik_common.inventory_cache import InventoryCache
+# ==============================================================================
+# Configuration
+# ==============================================================================
+# It is highly recommended to use environment variables for sensitive data.
+KENTIK_API_EMAIL = os.environ.get("KENTIK_API_EMAIL")
+KENTIK_API_TOKEN = os.environ.get("KENTIK_API_TOKEN")
+SNMP_COMMUNITY = os.environ.get("SNMP_COMMUNITY", "kentik")
+
+# The URL for your Kentik API endpoint.
+KENTIK_API_BASE_URL = "https://grpc.api.kentik.com"
+
+# The [[inputs.snmp]] block written for every device. $device_id, $device_ip,
+# $device_name, $snmp_community and $interval are filled in per device.
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snmp-device.conf.template")
+
+# Configs are written to one sub directory per collector instance: collector-1,
+# collector-2, ... Point each collector's telegraf at its own directory.
+OUTPUT_DIR = "./telegraf.d.generated"
+
+# Polling intervals (seconds). Devices with minimize SNMP set are polled less often.
+POLL_INTERVAL = 60
+MINIMIZED_POLL_INTERVAL = 600
+
+# Number of OIDs the template polls per device (system fields) and per interface
+# (ifTable columns). Used to estimate the polling cost of each device.
+SYSTEM_OIDS = 4
+INTERFACE_OIDS = 21
+
+# A device stays on the collector it is already on unless that would put the
+# collector more than this fraction above an even share of the total cost.
+BALANCE_TOLERANCE = 0.1
+
+# First line of every generated file. Only files starting with it are ever
+# rewritten or removed, hand-written configs are left alone.
+GENERATED_MARKER = "# Generated by generate-telegraf-configs.py from the Kentik device list, do not edit."
+
+# ==============================================================================
+# Helper Functions
+# ==============================================================================
+
+def device_ip(device):
+    """
+    Returns the address SNMP is polled on: the SNMP IP if set, else the first sending IP.
+    """
+    if device.get('deviceSnmpIp'):
+        return device['deviceSnmpIp']
+    sending_ips = device.get('sendingIps') or []
+    return sending_ips[0] if sending_ips else None
+
+def polling_cost(device, interface_count):
+    """
+    Returns (poll interval, estimated cost) of a device. The cost is the number of
+    OIDs polled per minute, so a device with twice the interfaces or polled twice
+    as often costs twice as much.
+    """
+    interval = MINIMIZED_POLL_INTERVAL if device.get('minimizeSnmp') else POLL_INTERVAL
+    return interval, (SYSTEM_OIDS + INTERFACE_OIDS * interface_count) * 60 / interval
+
+def config_file_name(device, with_id=False):
+    """
+    Returns the config file name of a device, its name reduced to [A-Za-z0-9._-].
+    With `with_id` the device id is added, for devices whose names reduce to the same file name.
+    """
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', device['deviceName'])
+    return f"{name}-{device['id']}.conf" if with_id else f"{name}.conf"
+
+def collector_dir(output_dir, shard):
+    return os.path.join(output_dir, f"collector-{shard + 1}")
+
+def generated_files(output_dir):
+    """
+    Returns [(file name, shard)] for the generated files already on disk.
+    """
+    files = []
+    if not os.path.isdir(output_dir):
+        return files
+    for entry in sorted(os.listdir(output_dir)):
+        match = re.fullmatch(r'collector-(\d+)', entry)
+        if not match:
+            continue
+        directory = os.path.join(output_dir, entry)
+        for file_name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, file_name)
+            if not file_name.endswith(".conf") or not os.path.isfile(path):
+                continue
+            with open(path, "r") as file:
+                if file.readline().rstrip("\n") == GENERATED_MARKER:
+                    files.append((file_name, int(match.group(1)) - 1))
+    return files
+
+def assign_shards(costs, shards, current=None):
+    """
+    Spreads the devices over `shards` collectors so their total costs stay balanced.
+    `costs` maps a device's file name to its cost and `current` its file name to the
+    shard it is on today. Devices keep their current shard while it has room, the
+    rest go, most expensive first, to the least loaded shard.
+    Returns {file name: shard}.
+    """
+    current = current or {}
+    target = sum(costs.values()) / shards * (1 + BALANCE_TOLERANCE)
+    loads = [0.0] * shards
+    assignments = {}
+    ordered = sorted(costs.items(), key=lambda item: (-item[1], item[0]))
+    for name, cost in ordered:
+        shard = current.get(name)
+        if shard is not None and shard < shards and loads[shard] + cost <= target:
+            assignments[name] = shard
+            loads[shard] += cost
+    heap = [(load, shard) for shard, load in enumerate(loads)]
+    heapq.heapify(heap)
+    for name, cost in ordered:
+        if name in assignments:
+            continue
+        load, shard = heapq.heappop(heap)
+        assignments[name] = shard
+        heapq.heappush(heap, (load + cost, shard))
+    return assignments
+
+def render_config(template, device, interval):
+    return f"{GENERATED_MARKER}\n" + template.substitute(
+        device_id=device['id'],
+        device_ip=device_ip(device),
+        device_name=device['deviceName'],
+        snmp_community=SNMP_COMMUNITY,
+        interval=f"{interval}s",
+    )
+
+def write_configs(output_dir, configs, assignments, shards):
+    """
+    Writes each config to its collector's directory if its content changed, and
+    removes generated files of devices that are gone or moved to another collector.
+    Returns (written, unchanged, removed) counts.
+    """
+    written = unchanged = removed = 0
+    for name, content in configs.items():
+        directory = collector_dir(output_dir, assignments[name])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                if file.read() == content:
+                    unchanged += 1
+                    continue
+        with open(path, "w") as file:
+            file.write(content)
+        written += 1
+    for name, shard in generated_files(output_dir):
+        if assignments.get(name) != shard:
+            os.remove(os.path.join(collector_dir(output_dir, shard), name))
+            removed += 1
+    return written, unchanged, removed
+
+# ==============================================================================
+# Main Execution
+# ==============================================================================
+
+def main(shards, output_dir=OUTPUT_DIR, refresh=False):
+    if not KENTIK_API_EMAIL or not KENTIK_API_TOKEN:
+        print("Error: Environment variables for Kentik API are not set.")
+        exit(1)
+    with open(TEMPLATE_PATH, "r") as file:
+        template = string.Template(file.read())
+
+    client = KentikClient(KENTIK_API_EMAIL, KENTIK_API_TOKEN, base_url=KENTIK_API_BASE_URL)
+    inventory = InventoryCache(client)
+    try:
+        devices = [device for device in inventory.list("devices", refresh=refresh) if device.get('deviceName')]
+        interfaces = inventory.interfaces_by_device([device['id'] for device in devices], refresh=refresh)
+    except requests.exceptions.RequestException as e:
+        print(f"Request failed: {e}.")
+        exit(1)
+    finally:
+        inventory.close()
+        client.close()
+
+    polled = []
+    for device in devices:
+        if not device_ip(device):
+            print(f"Skipping device {device['deviceName']}: no SNMP or sending IP.")
+            continue
+        polled.append(device)
+    # file names are compared case-insensitively, as they would collide on some file systems
+    name_counts = collections.Counter(config_file_name(device).lower() for device in polled)
+    configs = {}
+    costs = {}
+    for device in polled:
+        interval, cost = polling_cost(device, len(interfaces.get(str(device['id']), [])))
+        name = config_file_name(device)
+        if name_counts[name.lower()] > 1:
+            name = config_file_name(device, with_id=True)
+            print(f"Warning: device {device['deviceName']} shares the config file name of another device, writing it to {name}.")
+        configs[name] = render_config(template, device, interval)
+        costs[name] = cost
+
+    assignments = assign_shards(costs, shards, dict(generated_files(output_dir)))
+    written, unchanged, removed = write_configs(output_dir, configs, assignments, shards)
+
+    loads = [0.0] * shards
+    counts = [0] * shards
+    for name, shard in assignments.items():
+        loads[shard] += costs[name]
+        counts[shard] += 1
+    for shard in range(shards):
+        print(f"collector-{shard + 1}: {counts[shard]} devices, {loads[shard]:.0f} OIDs/min")
+    print(f"Configs written: {written}, unchanged: {unchanged}, removed: {removed}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--collectors", type=int, default=1, help="Number of collector instances to spread the devices over.")
+    parser.add_argument("--output", default=OUTPUT_DIR, help="Directory the collector-N config directories are written to.")
+    parser.add_argument("--refresh", action="store_true", help="Re-download the devices and interfaces instead of using the local cache.")
+    args = parser.parse_args()
+    main(max(1, args.collectors), args.output, args.refresh)
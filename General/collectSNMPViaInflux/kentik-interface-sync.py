@@ -1,7 +1,23 @@
+import argparse
+import hashlib
 import json
 import os
+import sys
 import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson decodes the telegraf files considerably faster when it is installed.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Make the shared kentik_common package at the repository root importable.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from kentik_common.client import KentikClient
+from kentik_common.inventory_cache import CACHE_DIR, DEVICE_BATCH_SIZE, InventoryCache
 # ==============================================================================
 # Configuration
 # ==============================================================================
@@ -17,37 +33,120 @@ KENTIK_API_CREATE_URL = f"{KENTIK_API_BASE_URL}/interface/v202108alpha1/interfac
 TELEGRAF_INTERFACE_DATA = "/var/log/telegraf/interface_metrics.json"
 TELEGRAF_IP_ADDRESS_DATA = "/var/log/telegraf/ip_address_metrics.json"
 
+# Number of devices whose interfaces are created/updated concurrently.
+MAX_WORKERS = 8
+
+# Daemon mode: how often the telegraf files are checked for changes (seconds),
+# where the fingerprints of the interfaces last sent are kept, and which interface
+# fields make up a fingerprint.
+POLL_INTERVAL = 5
+FINGERPRINT_FILE_PATH = os.environ.get(
+    "KENTIK_INTERFACE_FINGERPRINTS", os.path.join(CACHE_DIR, "interface_fingerprints.json")
+)
+FINGERPRINT_FIELDS = (
+    'deviceId', 'snmpId', 'snmpSpeed', 'snmpType', 'snmpAlias', 'interfaceDescription',
+    'interfaceIp', 'interfaceIpNetmask',
+)
+
 # ==============================================================================
 # Helper Functions
 # ==============================================================================
 
-def get_headers():
+_client = None
+_inventory = None
+
+def get_client():
+    """
+    Returns the pooled Kentik API client, creating it on first use.
+    """
+    global _client
+    if _client is None:
+        if not KENTIK_API_EMAIL or not KENTIK_API_TOKEN:
+            raise ValueError("Environment variables for Kentik API are not set.")
+        _client = KentikClient(KENTIK_API_EMAIL, KENTIK_API_TOKEN, base_url=KENTIK_API_BASE_URL, pool_maxsize=MAX_WORKERS)
+    return _client
+
+def get_inventory():
     """
-    Constructs the HTTP headers for authenticating with the Kentik API.
+    Returns the local inventory cache, so device interfaces aren't downloaded on every run.
     """
-    if not KENTIK_API_EMAIL or not KENTIK_API_TOKEN:
-        raise ValueError("Environment variables for Kentik API are not set.")
+    global _inventory
+    if _inventory is None:
+        _inventory = InventoryCache(get_client())
+    return _inventory
 
+def get_device_interfaces(device_ids):
+    """
+    Gathers the interfaces of many devices, listing them DEVICE_BATCH_SIZE devices
+    per request. Returns {(deviceId, snmpId): interface id}.
+    Raises the RequestException if the interfaces can't be listed, since without
+    them every interface would look new and be created again.
+    """
+    device_ids = [str(device_id) for device_id in device_ids]
+    print(f"Gathering the interfaces for {len(device_ids)} devices")
+    interfaces = get_inventory().interfaces_by_device(device_ids, batch_size=DEVICE_BATCH_SIZE)
     return {
-        "Content-Type": "application/json",
-        "X-CH-Auth-Email": KENTIK_API_EMAIL,
-        "X-CH-Auth-API-Token": KENTIK_API_TOKEN
+        (str(item['deviceId']), str(item['snmpId'])): item['id']
+        for items in interfaces.values() for item in items
+        if item.get('snmpId') is not None
     }
 
-def get_device_interfaces(device_id):
+def read_ndjson(path):
     """
-    Gathers a list of interfaces for a particular device.
-    An error is logged if a device does not exist. 
+    Yields the records of a newline-delimited JSON file one line at a time.
+    Telegraf rewrites its files every rotation_interval, so a last line that is
+    still being written (no newline yet and not valid JSON) is skipped.
+    """
+    with open(path, "rb") as file:
+        for line_number, line in enumerate(file, start=1):
+            complete = line.endswith(b"\n")
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json_loads(line)
+            except ValueError:
+                if complete:
+                    print(f"Skipping malformed line {line_number} in {path}")
+
+def merge_interface_data(interface_data, ip_address_data):
     """
-    print(f"Gathering the interfaces for device: {device_id}")
-    url = f"{KENTIK_API_CREATE_URL}?filters.deviceIds={int(device_id)}"
-    print(url)
-    response = send_request('GET', url, None)
-    interface_dict = response.json()
-    dict_item = {}
-    for item in interface_dict['interfaces']:
-        dict_item.update({item['interfaceDescription']: item['id']})
-    return dict_item
+    Merges the interface and IP address records in a single pass over each, keyed
+    by (device_name, ifindex). Later records of the same interface replace earlier
+    ones, and IP records are joined to the interface with the same ifindex.
+    Returns one {device_name: {'device_id': ..., 'interfaces': {ifindex: interface}}}
+    item per device. Records missing a field or with a non numeric speed or type
+    are skipped.
+    """
+    devices = {}
+    for item in interface_data:
+        tags = item.get('tags', {})
+        try:
+            interface = {
+                'deviceId': tags['device_id'],
+                'snmpId': tags['ifindex'],
+                'snmpSpeed': int(tags['speed']),
+                'snmpType': int(tags['type']),
+                'snmpAlias': tags.get('description', 'empty'),
+                'interfaceDescription': tags['ifDescr'],
+            }
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Skipping malformed interface record {tags}: {e!r}")
+            continue
+        device_name = tags.get('device_name', 'unknown')
+        if device_name not in devices:
+            devices[device_name] = {'device_id': tags['device_id'], 'interfaces': {}}
+        devices[device_name]['interfaces'][tags['ifindex']] = interface
+    for item in ip_address_data:
+        tags = item.get('tags', {})
+        device = devices.get(tags.get('device_name', 'unknown'))
+        interface = device['interfaces'].get(tags.get('ifindex', 'unknown')) if device else None
+        # IP records of interfaces that were not polled have nothing to attach to.
+        if interface is None or 'ip' not in tags or 'netmask' not in tags:
+            continue
+        interface['interfaceIp'] = tags['ip']
+        interface['interfaceIpNetmask'] = tags['netmask']
+    return [{device_name: device} for device_name, device in devices.items()]
 
 def build_consolidated_list():
     """
@@ -55,53 +154,12 @@ def build_consolidated_list():
     the data into one dictionary for all devices and interfaces.
     """
     print("Reading in the two telegraf data files and merging them into one list...")
-    consolidated_list = []
-    consolidated_dict = {}
-
-    with open(TELEGRAF_INTERFACE_DATA, "r") as file:
-        lines = file.readlines()
-        # Filter out blank lines and join with a comma
-        valid_lines = [line.strip() for line in lines if line.strip()]
-        fixed_json_string = "[" + ",".join(valid_lines) + "]"
-
-        # Load the fixed string as a single JSON array
-        interface_data = json.loads(fixed_json_string)
-
-    with open(TELEGRAF_IP_ADDRESS_DATA, "r") as file:
-        lines = file.readlines()
-        # Filter out blank lines and join with a comma
-        valid_lines = [line.strip() for line in lines if line.strip()]
-        fixed_json_string = "[" + ",".join(valid_lines) + "]"
-
-        # Load the fixed string as a single JSON array
-        ip_address_data = json.loads(fixed_json_string)
-    
-    
-    # Add the interface indexes to the dictionary items. 
-    for item in interface_data:
-        consolidated_dict = {}
-        device_name = item.get('tags', {}).get('device_name', 'unknown')
-        device_id = item.get('tags', {}).get('device_id', 'unknown')
-        if device_name not in consolidated_dict.get('device_name', {}):
-            consolidated_dict[device_name] = {}
-            consolidated_dict[device_name]['device_id'] = device_id
-            consolidated_dict[device_name]['interfaces'] = {}
-            for item in interface_data:
-                if item.get('tags', {}).get('device_name', 'unknown') == device_name:
-                    ifindex = item.get('tags', {}).get('ifindex', 'unknown')
-                    description = item.get('tags', {}).get('description', 'empty')
-                    consolidated_dict[device_name]['interfaces'][ifindex] = {}
-                    consolidated_dict[device_name]['interfaces'][ifindex]['deviceId'] = item['tags']['device_id']
-                    consolidated_dict[device_name]['interfaces'][ifindex]['snmpId'] = item['tags']['ifindex']
-                    consolidated_dict[device_name]['interfaces'][ifindex]['snmpSpeed'] = int(item['tags']['speed'])
-                    consolidated_dict[device_name]['interfaces'][ifindex]['snmpType'] = int(item['tags']['type'])
-                    consolidated_dict[device_name]['interfaces'][ifindex]['snmpAlias'] = description
-                    consolidated_dict[device_name]['interfaces'][ifindex]['interfaceDescription'] = item['tags']['ifDescr']
-            for item in ip_address_data:
-                if item.get('tags', {}).get('device_name', 'unknown') == device_name:
-                    consolidated_dict[device_name]['interfaces'][ifindex]['interfaceIp'] = item['tags']['ip']
-                    consolidated_dict[device_name]['interfaces'][ifindex]['interfaceIpNetmask'] = item['tags']['netmask']
-        consolidated_list.append(consolidated_dict)
+
+    # Records are streamed from the files straight into the merge, so memory use
+    # depends on the number of interfaces rather than on the size of the files.
+    consolidated_list = merge_interface_data(
+        read_ndjson(TELEGRAF_INTERFACE_DATA), read_ndjson(TELEGRAF_IP_ADDRESS_DATA)
+    )
     #print(consolidated_list)
     print("List merge complete...")
 
@@ -109,39 +167,198 @@ def build_consolidated_list():
 
 def send_request(method, url, data):
     """
-    Sends an HTTP request with exponential backoff for retries.
+    Sends an HTTP request through the shared client. Retries with exponential
+    backoff are handled by the client's retry policy.
     """
-    headers = get_headers()
-    max_retries = 5
-    delay = 1  # seconds
+    try:
+        response = get_client().request(method, url, json=data)
+        response.raise_for_status()
+        print(f"[{method}] Request to {url} successful.")
+        return response
+    except requests.exceptions.HTTPError as e:
+        print(f"[{method}] HTTP Error: {e.response.status_code} - {e.response.text}")
+        if e.response.status_code in [401, 403]:
+            print("Authentication failed. Exiting.")
+            return None
+    except requests.exceptions.RequestException as e:
+        print(f"Request failed: {e}.")
 
-    for i in range(max_retries):
-        try:
-            response = requests.request(method, url, json=data, headers=headers, timeout=10)
-            response.raise_for_status()
-            print(f"[{method}] Request to {url} successful.")
-            return response
-        except requests.exceptions.HTTPError as e:
-            print(f"[{method}] HTTP Error: {e.response.status_code} - {e.response.text}")
-            if e.response.status_code in [401, 403]:
-                print("Authentication failed. Exiting.")
-                return None
-            print(f"Retrying in {delay} seconds...")
-            time.sleep(delay)
-            delay *= 2
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}. Retrying in {delay} seconds...")
-            time.sleep(delay)
-            delay *= 2
-    
-    print("Max retries exceeded. Request failed.")
-    return response.text
+    print("Retries exhausted. Request failed.")
+    return None
+
+def changed_interfaces(device, fingerprints=None):
+    """
+    Returns the interfaces of a device to send: all of them, or only the ones whose
+    fingerprint changed if `fingerprints` is given.
+    """
+    interfaces = list(device['interfaces'].values())
+    if fingerprints is None:
+        return interfaces
+    return [
+        interface for interface in interfaces
+        if fingerprints.get(interface_key(interface)) != interface_fingerprint(interface)
+    ]
+
+def sync_device(device_name, interfaces, kentik_interfaces, fingerprints=None):
+    """
+    Creates or updates the given interfaces of one device in Kentik, one after the
+    other. `kentik_interfaces` maps (deviceId, snmpId) to the existing interface ids.
+    The fingerprints of the interfaces written successfully are recorded in
+    `fingerprints` if given. An unexpected error stops this device only, its
+    remaining interfaces are sent by the next sync.
+    """
+    print(f"Creating interfaces for device: {device_name}")
+    try:
+        _sync_device_interfaces(interfaces, kentik_interfaces, fingerprints)
+    except Exception as e:
+        print(f"Error syncing the interfaces of device {device_name}: {e!r}")
+
+def _sync_device_interfaces(interfaces, kentik_interfaces, fingerprints):
+    """Sends the interfaces of one device, see sync_device."""
+    for interface in interfaces:
+        interface_payload = {}
+        interface_payload['interface'] = dict(interface)
+        print(interface_payload)
+        interface_id = kentik_interfaces.get((str(interface['deviceId']), str(interface['snmpId'])))
+        if interface_id is not None:
+            print(f"Interface {interface['interfaceDescription']} exist, updating...")
+            interface_payload['interface']['id'] = interface_id
+            response = send_request('PUT', f"{KENTIK_API_CREATE_URL}/{int(interface_id)}", interface_payload)
+        else:
+            print(f"Interface {interface['interfaceDescription']} does not exist, creating...")
+            response = send_request('POST', KENTIK_API_CREATE_URL, interface_payload)
+        if response is not None:
+            try:
+                written = response.json().get('interface') or {}
+            except ValueError:
+                written = {}
+            record = {**interface_payload['interface'], **written}
+            if record.get('id') is not None:
+                # Keep the cached interface list current for the next run.
+                get_inventory().upsert('interfaces', record)
+            else:
+                # The id of the created interface is unknown, list the device's interfaces again next time.
+                get_inventory().invalidate(f"interfaces:{interface['deviceId']}")
+            if fingerprints is not None:
+                fingerprints[interface_key(interface)] = interface_fingerprint(interface)
+
+def sync_interfaces(telegraf_interface_data, fingerprints=None, workers=MAX_WORKERS):
+    """
+    Creates or updates the interfaces of every device in the merged telegraf data.
+    The existing interfaces of all devices are fetched in batches up front, then the
+    devices are synced by a pool of `workers` threads. Each device's interfaces
+    are sent in order by a single worker.
+    Returns False, without sending anything, if the existing interfaces can't be listed.
+    """
+    pending = []
+    for device in telegraf_interface_data:
+        for device_name in device:
+            interfaces = changed_interfaces(device[device_name], fingerprints)
+            if interfaces:
+                pending.append((device_name, device[device_name]['device_id'], interfaces))
+    if not pending:
+        return True
+    try:
+        kentik_interfaces = get_device_interfaces(device_id for _, device_id, _ in pending)
+    except requests.exceptions.RequestException as e:
+        print(f"Request failed: {e}. Could not list the existing interfaces, skipping this sync.")
+        return False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(sync_device, device_name, interfaces, kentik_interfaces, fingerprints)
+            for device_name, _, interfaces in pending
+        ]
+        for future in futures:
+            future.result()
+    return True
+
+# ==============================================================================
+# Daemon Mode
+# ==============================================================================
+
+def interface_key(interface):
+    return f"{interface['deviceId']}:{interface['snmpId']}"
+
+def interface_fingerprint(interface):
+    """
+    Returns a hash of the interface fields sent to Kentik.
+    """
+    fields = {field: interface.get(field) for field in FINGERPRINT_FIELDS}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+def load_fingerprints(path=FINGERPRINT_FILE_PATH):
+    """
+    Returns the interface fingerprints saved by the last run, keyed by deviceId:snmpId.
+    """
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_fingerprints(fingerprints, path=FINGERPRINT_FILE_PATH):
+    """
+    Writes the fingerprints to a temporary file first, so a crash never leaves a
+    half written file behind.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(fingerprints, file)
+    os.replace(temp_path, path)
+
+def file_state(path):
+    """
+    Returns what identifies a version of a file: a rotation changes the inode and a
+    rewrite the modification time or size. None if the file does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+def run_daemon(poll_interval=POLL_INTERVAL, fingerprint_path=FINGERPRINT_FILE_PATH, workers=MAX_WORKERS):
+    """
+    Follows the telegraf files and, each time telegraf writes or rotates them,
+    sends only the interfaces whose fingerprint changed since they were last sent.
+    """
+    fingerprints = load_fingerprints(fingerprint_path)
+    last_states = None
+    print(f"Watching {TELEGRAF_INTERFACE_DATA} and {TELEGRAF_IP_ADDRESS_DATA} every {poll_interval}s...")
+    while True:
+        states = (file_state(TELEGRAF_INTERFACE_DATA), file_state(TELEGRAF_IP_ADDRESS_DATA))
+        if None not in states and states != last_states:
+            last_states = states
+            try:
+                if not sync_interfaces(build_consolidated_list(), fingerprints, workers):
+                    # Retried on the next poll.
+                    last_states = None
+            except FileNotFoundError:
+                # Rotated away between the stat and the read, picked up on the next poll.
+                last_states = None
+            except Exception as e:
+                # Keep the daemon running, the files are synced again once they change.
+                print(f"Error syncing the telegraf files: {e!r}")
+            save_fingerprints(fingerprints, fingerprint_path)
+        time.sleep(poll_interval)
 
 # ==============================================================================
 # Main Execution
 # ==============================================================================
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--daemon", action="store_true", help="Keep running, following the telegraf files and sending only interfaces that changed.")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="Seconds between checks of the telegraf files in --daemon mode.")
+    parser.add_argument("--fingerprints", default=FINGERPRINT_FILE_PATH, help="File holding the fingerprints of the interfaces last sent.")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Number of devices whose interfaces are sent concurrently.")
+    args = parser.parse_args()
+
+    # The daemon waits for the files to appear itself.
+    if args.daemon:
+        run_daemon(args.poll_interval, args.fingerprints, args.workers)
+
     if not os.path.exists(TELEGRAF_INTERFACE_DATA):
         print(f"Error: Telegraf output file not found at {TELEGRAF_INTERFACE_DATA}")
         exit(1)
@@ -153,21 +370,7 @@ if __name__ == "__main__":
     # Build a merge list of the telegraf data.
     telegraf_interface_data = build_consolidated_list()
     #print(telegraf_interface_data)
-    for device in telegraf_interface_data:
-        for device_name in device:
-            print(f"Creating interfaces for device: {device_name}")
-            kentik_interface_list = get_device_interfaces(device[device_name]['device_id'])
-            print(kentik_interface_list)
-            for interface in device[device_name]['interfaces']:
-                interface_payload = {}
-                interface_payload['interface'] = device[device_name]['interfaces'][interface]
-                print(interface_payload)
-                if device[device_name]['interfaces'][interface]['interfaceDescription'] in kentik_interface_list:
-                    print(f"Interface {device[device_name]['interfaces'][interface]['interfaceDescription']} exist, updating...")
-                    interface_payload['interface']['id'] = kentik_interface_list[device[device_name]['interfaces'][interface]['interfaceDescription']]
-                    send_request('PUT', f"{KENTIK_API_CREATE_URL}/{int(interface_payload['interface']['id'])}", interface_payload)
-                else:
-                    print(f"Interface {device[device_name]['interfaces'][interface]['interfaceDescription']} does not exist, creating...")
-                    send_request('POST', KENTIK_API_CREATE_URL, interface_payload)
+    if not sync_interfaces(telegraf_interface_data, workers=args.workers):
+        exit(1)
 
     print("Script finished.")
\ No newline at end of file
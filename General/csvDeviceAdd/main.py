@@ -1,10 +1,19 @@
-import pandas as pd
 import requests
+import argparse
+import csv
 import json
-import time
 import os
+import sys
 import random
 import math
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
+# Make the shared kentik_common package at the repository root importable.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from kentik_common.client import KentikClient
+from kentik_common.inventory_cache import InventoryCache
+from kentik_common.reconcile import KENTIK_DEVICE_ALIASES, diff_fields, diff_ids, format_changes
 
 # --- Configuration ---
 # IMPORTANT: Replace with your actual Kentik API credentials
@@ -12,8 +21,26 @@ KENTIK_API_EMAIL = os.getenv('KENTIK_EMAIL')
 KENTIK_API_TOKEN = os.getenv('KENTIK_TOKEN')
 KENTIK_API_BASE_URL = "https://grpc.api.kentik.com" # Kentik API v6 base URL
 
+# Upper bound for --workers, also used as the connection pool size.
+MAX_WORKERS = 32
+
+# One pooled, keep-alive client reused for every API call made by this script.
+# Its shared rate limiter paces requests from the API's rate limit headers.
+KENTIK_CLIENT = KentikClient(KENTIK_API_EMAIL, KENTIK_API_TOKEN, base_url=KENTIK_API_BASE_URL, pool_maxsize=MAX_WORKERS)
+
+# Local mirror of the devices, sites and labels so they aren't downloaded on every run.
+INVENTORY = InventoryCache(KENTIK_CLIENT)
+
 # Path to your CSV file
 CSV_FILE_PATH = "./device_list.csv"
+REQUIRED_HEADERS = ['device_name', 'ip_address', 'site', "role", "lane", "function", "type"]
+# Rows are streamed from the CSV and processed this many at a time, so memory
+# stays flat no matter how large the file is.
+CHUNK_SIZE = 1000
+
+# Path of the per-row result report
+REPORT_FILE_PATH = "./device_report.csv"
+REPORT_HEADERS = ['row', 'device_name', 'ip_address', 'status', 'labels', 'device_id']
 
 # COLOR LIST
 COLOR_LIST = ["#91a3b0", "#b64605", "#374d5d", "#2c4d1d", "#3970a7", "#fae57c"]
@@ -21,43 +48,98 @@ COLOR_LIST = ["#91a3b0", "#b64605", "#374d5d", "#2c4d1d", "#3970a7", "#fae57c"]
 CUSTOMER_SNMP_COMMUNITY = ""
 
 # --- Helper Functions ---
-def _gather_device_list():
-    response = _make_kentik_api_call("GET", "device/v202308beta1/device", None, "query.noCustomColumns=true")
-    device_dict = response
-    device_list = []
-    for item in device_dict["devices"]:
-        device_list.append(item['deviceName'])
-    return device_dict, device_list
-
-def _gather_all_sites():
-    response = _make_kentik_api_call("GET", "site/v202211/sites")
-    return response
-
-def _gather_all_labels():
-    response = _make_kentik_api_call("GET", "label/v202210/labels")
-    label_dict = response
+def _gather_device_list(refresh=False):
+    device_dict = {"devices": INVENTORY.list("devices", refresh)}
+    device_index = _build_device_index(device_dict)
+    return device_dict, device_index
+
+def _gather_all_sites(refresh=False):
+    return {"sites": INVENTORY.list("sites", refresh)}
+
+def _gather_all_labels(refresh=False):
+    label_dict = {"labels": INVENTORY.list("labels", refresh)}
     return label_dict
 
+def _read_csv_headers(csv_path):
+    """Returns the header row of the CSV file."""
+    with open(csv_path, newline='') as csv_file:
+        return next(csv.reader(csv_file), [])
+
+def _read_csv_rows(csv_path):
+    """Streams (row number, row dict) tuples from the CSV file, one line at a time."""
+    with open(csv_path, newline='') as csv_file:
+        for index, row in enumerate(csv.DictReader(csv_file)):
+            yield index, row
+
+def _chunked(rows, size):
+    """Groups an iterable into lists of at most `size` items."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _missing_field(value):
+    """True for blank CSV cells (empty strings, None or a NaN float)."""
+    if isinstance(value, float):
+        return math.isnan(value)
+    return value is None or str(value).strip() == ''
+
+def _build_device_index(existing_devices):
+    """
+    Indexes devices by lowercase device name and by sending IP, so each CSV row
+    is matched with dictionary lookups instead of scanning the whole inventory.
+    """
+    device_index = {'names': {}, 'ips': {}}
+    for device in existing_devices['devices']:
+        _index_device(device_index, device)
+    return device_index
+
+def _index_device(device_index, device):
+    """Adds a device, fetched or just created, to the device index."""
+    device_index['names'][device['deviceName'].lower()] = device
+    sending_ips = device.get('sendingIps') or []
+    if isinstance(sending_ips, str):
+        sending_ips = [sending_ips]
+    for ip in sending_ips:
+        device_index['ips'][ip] = device
+
+def _find_device(device_data, device_index):
+    """Returns the existing device matching the row's name, name.visa.com alias or IP, or None."""
+    device_name = device_data['device_name'].lower()
+    for name in (device_name, f"{device_name}.visa.com"):
+        if name in device_index['names']:
+            return device_index['names'][name]
+    ip_address = device_data['ip_address']
+    # Devices that were added by IP are named after it.
+    return device_index['names'].get(ip_address.lower()) or device_index['ips'].get(ip_address)
+
+def _build_site_index(existing_sites):
+    """Maps site title to site id."""
+    return {site['title']: site['id'] for site in existing_sites['sites']}
+
+def _build_label_index(existing_labels):
+    """Maps lowercase label name to label id."""
+    return {label['name'].lower(): label['id'] for label in existing_labels['labels']}
+
 def _make_kentik_api_call(method, endpoint, data=None, params=None):
     """
     Helper function to make API calls to Kentik.
-    Handles authentication, error checking, and rate limiting.
+    Handles authentication, error checking, and rate limiting. Requests go through
+    the shared KENTIK_CLIENT so connections are reused and retried consistently.
     """
-    headers = {
-        "X-CH-Auth-Email": KENTIK_API_EMAIL,
-        "X-CH-Auth-API-Token": KENTIK_API_TOKEN,
-        "Content-Type": "application/json"
-    }
-    url = f"{KENTIK_API_BASE_URL}/{endpoint}"
     try:
         if method.upper() == "GET":
-            response = requests.get(url, headers=headers, params=params)
+            response = KENTIK_CLIENT.get(endpoint, params=params)
         elif method.upper() == "POST":
-            response = requests.post(url, headers=headers, json=data)
+            response = KENTIK_CLIENT.post(endpoint, json=data)
         elif method.upper() == "PUT":
-            response = requests.put(url, headers=headers, json=data)
+            response = KENTIK_CLIENT.put(endpoint, json=data)
         elif method.upper() == "DELETE":
-            response = requests.delete(url, headers=headers)
+            response = KENTIK_CLIENT.delete(endpoint)
         else:
             print(f"Error: Unsupported HTTP method '{method}'")
             return None
@@ -75,29 +157,104 @@ def _make_kentik_api_call(method, endpoint, data=None, params=None):
         print(f"!!! An unexpected error occurred: {req_err} !!!")
     return None
 
-def create_device(device_data, existing_devices, devices_list, existing_sites):
-    """Creates a new device in Kentik."""
-    #print(f"Attempting to create device: '{device_data['device_name']}'")
-    site_id = False
-    for site in existing_sites['sites']:
-        if device_data['site'] == site['title']:
-            #print(f"Site {device_data['site']} exists.")
-            site_id = site['id']
-    if not site_id:
-        #print(f"Site {device_data['site']} does not exists.")
-        #print(f"Creating site,{device_data['site']}")
-        payload = {
-            "site": {
-                "title": device_data['site'],
-                "type": "SITE_TYPE_OTHER"
-            }
+def _create_site(title):
+    """Creates a site and returns its id, or None on failure."""
+    #print(f"Creating site,{title}")
+    payload = {
+        "site": {
+            "title": title,
+            "type": "SITE_TYPE_OTHER"
         }
-        site_data = _make_kentik_api_call("POST", "site/v202211/sites", data=payload, params=None)
-        if site_data:
-            site_id = site_data['site']['id']
-        else:
-            print(f"!!!ERROR - Could not create the site. {device_data['site']}")
-            return None
+    }
+    site_data = _make_kentik_api_call("POST", "site/v202211/sites", data=payload, params=None)
+    if site_data:
+        INVENTORY.upsert("sites", site_data['site'])
+        return site_data['site']['id']
+    print(f"!!!ERROR - Could not create the site. {title}")
+    return None
+
+def _create_label(name):
+    """Creates a label and returns its id, or None on failure."""
+    #print(f"Need to create label: {name}")
+    label_payload = {
+        "label": {
+            "name": name,
+            "description": name,
+            "color": random.choice(COLOR_LIST)
+        }
+    }
+    label_data = _make_kentik_api_call("POST", "label/v202210/labels", data=label_payload)
+    if label_data:
+        INVENTORY.upsert("labels", label_data['label'])
+        return label_data['label']['id']
+    print(f"!!!ERROR - Could not create the label. {name}")
+    return None
+
+def _row_is_complete(row):
+    """True if the row has the device name, IP address and site needed to process it."""
+    return not (_missing_field(row['device_name']) or _missing_field(row['ip_address']) or _missing_field(row['site']))
+
+def _row_labels(row):
+    """Returns the row's non-blank role, lane, function and type labels."""
+    labels = [row['role'], row['lane'], row['function'], row['type']]
+    return [label for label in labels if not _missing_field(label)]
+
+def collect_sites_and_labels(csv_path):
+    """
+    Pre-pass over the CSV that returns the distinct sites and labels referenced by
+    rows that will be processed. Labels are deduplicated case-insensitively.
+    """
+    sites = set()
+    labels = {}
+    for index, row in _read_csv_rows(csv_path):
+        if not _row_is_complete(row):
+            continue
+        sites.add(row['site'])
+        for label in _row_labels(row):
+            labels.setdefault(label.lower(), label)
+    return sites, list(labels.values())
+
+def materialize_sites_and_labels(executor, sites, labels, site_index, label_index, plan=False):
+    """
+    Creates the sites and labels that don't exist yet, once each and concurrently.
+    Returns read-only copies of the site and label id maps for the device phase,
+    which only reads them and so needs no locking.
+    """
+    missing_sites = sorted(site for site in sites if site not in site_index)
+    missing_labels = sorted(label for label in labels if label.lower() not in label_index)
+    if plan:
+        for site in missing_sites:
+            print(f"PLAN: CREATE site '{site}'")
+        for label in missing_labels:
+            print(f"PLAN: CREATE label '{label}'")
+    else:
+        site_futures = {site: executor.submit(_create_site, site) for site in missing_sites}
+        label_futures = {label: executor.submit(_create_label, label) for label in missing_labels}
+        for site, future in site_futures.items():
+            if future.result():
+                site_index[site] = future.result()
+        for label, future in label_futures.items():
+            if future.result():
+                label_index[label.lower()] = future.result()
+        created_sites = sum(1 for future in site_futures.values() if future.result())
+        created_labels = sum(1 for future in label_futures.values() if future.result())
+        print(f"Created {created_sites} sites and {created_labels} labels.")
+    return MappingProxyType(dict(site_index)), MappingProxyType(dict(label_index))
+
+def create_device(device_data, device_index, site_index, plan=False):
+    """
+    Creates a new device in Kentik, or updates it if it already exists and differs from the row.
+    `site_index` must already contain the row's site, see materialize_sites_and_labels.
+    Returns a tuple of (device id or None, status) where status is "created", "updated",
+    "unchanged" or "failed". With plan=True nothing is written, the planned change is
+    printed and the status is "create", "update" or "unchanged".
+    """
+    #print(f"Attempting to create device: '{device_data['device_name']}'")
+    # Missing sites were created by the pre-pass (or are planned to be, with plan=True).
+    site_id = site_index.get(device_data['site'])
+    if not site_id and not plan:
+        print(f"!!!ERROR - Site {device_data['site']} does not exist.")
+        return None, "failed"
 
     device_payload = {
         "device": {
@@ -115,63 +272,67 @@ def create_device(device_data, existing_devices, devices_list, existing_sites):
         }
     }
     # Check if device already exists
-    response = None
-    if device_data['device_name'].lower() in devices_list or f"{device_data['device_name']}.visa.com".lower() in devices_list:
-        #print(f"Device already exists with name: '{device_data['device_name']}'")
+    device = _find_device(device_data, device_index)
+    if device:
+        #print(f"Device already exists with name: '{device['deviceName']}'")
+        changes = diff_fields(device_payload['device'], device, aliases=KENTIK_DEVICE_ALIASES)
+        if not changes:
+            return device['id'], "unchanged"
+        if plan:
+            print(f"PLAN: UPDATE device '{device['deviceName']}' ({device['id']})\n{format_changes(changes)}")
+            return device['id'], "update"
         #print(f"Attempting to update device: '{device_data['device_name']}")
-        for device in existing_devices['devices']:
-            if device['deviceName'].lower() == device_data['device_name'].lower() or device['deviceName'].lower() == f"{device_data['device_name']}.visa.com".lower():
-                device_payload['device']['id'] = device['id']
-        if 'visa.com' in device_data['device_name'].lower() and device_payload['device'].get('id'):
-            response = _make_kentik_api_call("PUT", f"device/v202308beta1/device/{device_payload['device']['id']}", data=device_payload)
-        elif device_payload['device'].get('id'):
-            device_data['device_name'] = f"{device_data['device_name']}.visa.com"
-            response = _make_kentik_api_call("PUT", f"device/v202308beta1/device/{device_payload['device']['id']}", data=device_payload)
-        else:
-            print(f"!!!ERROR - Device ID Not found - {device_data['device_name']}")
-    elif device_data['ip_address'] in devices_list:
-        #print(f"Device already exists with name: '{device_data['ip_address']}'")
-        #print(f"Attempting to update device: '{device_data['device_name']}'")
-        for device in existing_devices['devices']:
-            if device['deviceName'].lower() == device_data['ip_address'].lower():
-                device_payload['device']['id'] = device['id']
+        device_payload['device']['id'] = device['id']
         response = _make_kentik_api_call("PUT", f"device/v202308beta1/device/{device_payload['device']['id']}", data=device_payload)
+        if response and 'device' in response:
+            # Later rows for the same device are compared against the updated record.
+            device.update(response['device'])
+            INVENTORY.upsert("devices", device)
     else:
+        if plan:
+            print(f"PLAN: CREATE device '{device_data['device_name']}' ({device_data['ip_address']})")
+            return None, "create"
         response = _make_kentik_api_call("POST", "device/v202308beta1/device", data=device_payload)
+        if response and 'device' in response:
+            # Later rows for the same device must update it rather than create it again.
+            created_device = {**device_payload['device'], **response['device']}
+            _index_device(device_index, created_device)
+            INVENTORY.upsert("devices", created_device)
     if response and 'device' in response:
         #print(f"Successfully created device: '{device_data['device_name']}' (ID: {response['device']['id']})")
-        return response['device']['id']
+        return response['device']['id'], "updated" if device_payload['device'].get('id') else "created"
     print(f"!!! Error: Failed to create or update device: '{device_data['device_name']}' !!!")
-    if device_payload['device'].get('id'):
-        return device_payload['device']['id']
-    else:
-        return None
+    return device_payload['device'].get('id'), "failed"
 
 
-def update_labels_device(device_data, device_id, existing_devices, existing_labels):
-    """Creates a new device in Kentik."""
+def update_labels_device(device_data, device_id, label_index, device=None, plan=False):
+    """
+    Sets the row's role, lane, function and type labels on the device.
+    `device` is the fetched device record. The labels PUT is skipped when its labels already match.
+    Returns "updated", "unchanged" or "failed", or with plan=True "update" or "unchanged".
+    """
     #print(f"Attempting to add labels to the device: '{device_data['device_name']}'")
     label_ids = []
-    labels = [device_data['role'], device_data['lane'], device_data['function'], device_data['type']]
-    for label in labels:
-        label_exists = False
-        for existing_label in existing_labels['labels']:
-            if existing_label["name"].lower() == label.lower():
-                label_ids.append(existing_label['id'])
-                label_exists = True
-        if not label_exists:
-            #print(f"Need to create label: {label}")
-            label_payload = {
-                "label": {
-                    "name": label,
-                    "description": label,
-                    "color": random.choice(COLOR_LIST)
-                }
-            }
-            response = _make_kentik_api_call("POST", "label/v202210/labels", data=label_payload)
-            label_return = response
-            label_ids.append(label_return['label']['id'])
-            existing_labels['labels'].append(label_return['label'])
+    missing_labels = []
+    for label in _row_labels(device_data):
+        if label.lower() in label_index:
+            label_ids.append(label_index[label.lower()])
+        else:
+            missing_labels.append(label)
+    # Missing labels were created by the pre-pass (or are planned to be, with plan=True).
+    if missing_labels and not plan:
+        print(f"!!!ERROR - Labels {missing_labels} do not exist.")
+        return "failed"
+
+    current_ids = [label['id'] for label in (device or {}).get('labels') or []]
+    removed, added = diff_ids(label_ids, current_ids)
+    if device and not missing_labels and not removed and not added:
+        return "unchanged"
+    if plan:
+        name = device['deviceName'] if device else device_data['device_name']
+        print(f"PLAN: LABELS device '{name}' remove {removed} add {added + missing_labels}")
+        return "update"
+
     labels_list = []
     for label in label_ids:
         label_dict = {"id": int(label)}
@@ -182,23 +343,109 @@ def update_labels_device(device_data, device_id, existing_devices, existing_labe
         "labels": labels_list
     }
     response = _make_kentik_api_call("PUT", f"device/v202308beta1/device/{device_id}/labels", data=payload)
+    if not response:
+        return "failed"
+    if device is not None:
+        device['labels'] = labels_list
+        INVENTORY.upsert("devices", device)
+    return "updated"
 
-    return None
+def process_rows(rows, device_index, site_index, label_index, plan=False):
+    """
+    Processes CSV rows that belong to the same device, in order.
+    For each row the device is created/updated before its labels are set.
+    Returns a report entry per row.
+    """
+    results = []
+    for index, row in rows:
+        device_name = row['device_name']
+        ip_address = row['ip_address']
+        result = {'row': index, 'device_name': device_name, 'ip_address': ip_address, 'status': 'failed', 'labels': '', 'device_id': ''}
+        results.append(result)
+        if not _row_is_complete(row):
+            print(f"!!!ERROR - {device_name} does not have a necessary field")
+            result['status'] = 'skipped'
+            continue
+        #print(f"\n--- Processing Device: {device_name} (IP: {ip_address}) ---")
+        try:
+            device_id, status = create_device(row, device_index, site_index, plan)
+            result['status'] = status
+            if device_id or status == 'create':
+                result['device_id'] = device_id or ''
+                #print(f"\n--- Adding labels to Device: {device_name} (IP: {ip_address}) ---")
+                device = _find_device(row, device_index) if device_id else None
+                result['labels'] = update_labels_device(row, device_id, label_index, device, plan)
+        except Exception as e:
+            result['status'] = 'failed'
+            print(f"!!!ERROR - {device_name} could not be processed: {e}")
+    return results
+
+def _row_device_keys(row, device_index):
+    """
+    Returns the keys that identify the row's device, the same way _find_device
+    matches it: its name without .visa.com, its IP (devices added by IP are named
+    after it) and the id of the existing device it matches.
+    """
+    keys = []
+    if not _missing_field(row['device_name']):
+        keys.append(str(row['device_name']).lower().removesuffix('.visa.com'))
+    if not _missing_field(row['ip_address']):
+        keys.append(str(row['ip_address']).lower())
+    if _row_is_complete(row):
+        device = _find_device(row, device_index)
+        if device is not None:
+            keys.append(f"id:{device['id']}")
+    return keys
+
+def _group_device_rows(chunk, device_index):
+    """
+    Groups the chunk's rows by device: rows sharing a name, an IP or a matched
+    existing device end up in the same group, in CSV order.
+    Returns a list of [(index, row)] groups.
+    """
+    parents = list(range(len(chunk)))
 
+    def root(position):
+        while parents[position] != position:
+            parents[position] = parents[parents[position]]
+            position = parents[position]
+        return position
 
+    first_rows = {}
+    for position, (_, row) in enumerate(chunk):
+        for key in _row_device_keys(row, device_index):
+            parents[root(position)] = root(first_rows.setdefault(key, position))
+    groups = {}
+    for position, item in enumerate(chunk):
+        groups.setdefault(root(position), []).append(item)
+    return list(groups.values())
 
-def main():
+def process_chunk(executor, chunk, device_index, site_index, label_index, plan=False):
+    """
+    Processes one chunk of CSV rows. Rows for the same device are kept together and
+    run in order, rows for different devices run concurrently across the workers.
+    Returns the chunk's report entries ordered by CSV row.
+    """
+    futures = [
+        executor.submit(process_rows, rows, device_index, site_index, label_index, plan)
+        for rows in _group_device_rows(chunk, device_index)
+    ]
+    results = []
+    for future in futures:
+        results.extend(future.result())
+    return sorted(results, key=lambda item: item['row'])
+
+def main(workers=1, report_path=REPORT_FILE_PATH, plan=False, chunk_size=CHUNK_SIZE, refresh=False):
     """Main function to orchestrate the site and device creation."""
     print("Starting Kentik automation script...")
 
     # 1: Gather the current list of devices.
 
-    existing_devices, devices_list = _gather_device_list()
+    existing_devices, device_index = _gather_device_list(refresh)
 
-    # 2. Read CSV file
+    # 2. Check the CSV file
     try:
-        df = pd.read_csv(CSV_FILE_PATH)
-        print(f"Successfully loaded CSV file: '{CSV_FILE_PATH}' with {len(df)} entries.")
+        headers = _read_csv_headers(CSV_FILE_PATH)
     except FileNotFoundError:
         print(f"Error: CSV file not found at '{CSV_FILE_PATH}'. Please check the path.")
         return
@@ -207,33 +454,47 @@ def main():
         return
 
     # 3 Ensure required columns exist
-    required_headers = ['device_name', 'ip_address', 'site', "role", "lane", "function", "type"]
-    if not all(header in df.columns for header in required_headers):
-        print(f"Error: CSV file must contain all required headers: {', '.join(required_headers)}")
+    if not all(header in headers for header in REQUIRED_HEADERS):
+        print(f"Error: CSV file must contain all required headers: {', '.join(REQUIRED_HEADERS)}")
         return
 
     # 4 Get existing sites once to minimize API calls
-    existing_sites = _gather_all_sites()
+    site_index = _build_site_index(_gather_all_sites(refresh))
 
-    # 5 Next process and add the labels
-    existing_labels = _gather_all_labels()
+    # 5 Next gather the existing labels
+    label_index = _build_label_index(_gather_all_labels(refresh))
 
-    # 6 Process each row in the CSV
-    for index, row in df.iterrows():
-        device_name = row['device_name']
-        ip_address = row['ip_address']
-        site = row['site']
-        if type(device_name) is float or type(ip_address) is float or type(site) is float:
-            print(f"!!!ERROR - {device_name} does not have a necessary field")
-            continue
-        #print(f"\n--- Processing Device: {device_name} (IP: {ip_address}) ---")
-        device_id = create_device(row, existing_devices, devices_list, existing_sites)
-        if device_id:
-            #print(f"\n--- Adding labels to Device: {device_name} (IP: {ip_address}) ---")
-            update_labels_device(row, device_id, existing_devices, existing_labels)
-        time.sleep(2)
+    workers = max(1, min(workers, MAX_WORKERS))
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(report_path, 'w', newline='') as report_file:
+        # 6 Pre-pass: create every site and label the CSV references once, up front,
+        # so the device phase only reads the id maps.
+        sites, labels = collect_sites_and_labels(CSV_FILE_PATH)
+        site_index, label_index = materialize_sites_and_labels(executor, sites, labels, site_index, label_index, plan)
+
+        # 7 Stream the CSV rows through the workers a chunk at a time. Chunks run one
+        # after another, so rows for the same device keep their order across chunks
+        # and the report is written in CSV row order.
+        summary = {}
+        row_count = 0
+        writer = csv.DictWriter(report_file, fieldnames=REPORT_HEADERS)
+        writer.writeheader()
+        for chunk in _chunked(_read_csv_rows(CSV_FILE_PATH), chunk_size):
+            for result in process_chunk(executor, chunk, device_index, site_index, label_index, plan):
+                writer.writerow(result)
+                summary[result['status']] = summary.get(result['status'], 0) + 1
+            row_count += len(chunk)
+            print(f"Processed {row_count} rows from '{CSV_FILE_PATH}'.")
 
+    print(f"Wrote results for {row_count} rows to '{report_path}'.")
+    print(f"{'Planned' if plan else 'Applied'} changes per row: {summary}")
     print("\nKentik automation script finished.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help=f"Number of devices to process concurrently (max {MAX_WORKERS}).")
+    parser.add_argument("--report", default=REPORT_FILE_PATH, help="Path of the per-row result report (CSV).")
+    parser.add_argument("--plan", action="store_true", help="Only print the changes that would be made, do not write to the API.")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Number of CSV rows read and processed at a time.")
+    parser.add_argument("--refresh", action="store_true", help="Re-download the device, site and label inventory instead of using the local cache.")
+    args = parser.parse_args()
+    main(workers=args.workers, report_path=args.report, plan=args.plan, chunk_size=args.chunk_size, refresh=args.refresh)
@@ -1,21 +1,29 @@
 import requests
+import argparse
+import hashlib
+import hmac
 import json
 import os
-import time
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Make the shared kentik_common package at the repository root importable.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from kentik_common.client import ApiClient, KentikClient
+from kentik_common.inventory_cache import CACHE_DIR, DEFAULT_TTL, InventoryCache
+from kentik_common.reconcile import diff_ids
 
 # --- Configuration ---
 # IMPORTANT: Replace with your actual Kentik API credentials
 KENTIK_API_EMAIL = os.getenv('KENTIK_EMAIL')
 KENTIK_API_TOKEN = os.getenv('KENTIK_TOKEN')
 REGION = "US" # Set the region if you use EU
-KENTIK_API_BASE_URL = "https://grpc.api.kentik.com" # Kentik API v6 base URL
+# Kentik API v6 base URL
+KENTIK_API_BASE_URL = "https://grpc.api.kentik.eu" if REGION == "EU" else "https://grpc.api.kentik.com"
 API_VERSION = "v202308beta1"
-KENTIK_HEADERS = {
-        "X-CH-Auth-Email": KENTIK_API_EMAIL,
-        "X-CH-Auth-API-Token": KENTIK_API_TOKEN,
-        "Content-Type": "application/json"
-    }
 NETBOX_BASE_URL = os.getenv('NETBOX_URL')
 NETBOX_TOKEN = os.getenv('NETBOX_TOKEN')
 NETBOX_HEADERS = {
@@ -23,206 +31,570 @@ NETBOX_HEADERS = {
         "Accept": "application/json",
         "Content-Type": "application/json",
     }
+# NetBox list endpoints are paged: objects per page (NetBox caps it at its
+# MAX_PAGE_SIZE, 1000 by default) and number of pages fetched concurrently.
+NETBOX_PAGE_SIZE = 1000
+NETBOX_WORKERS = 8
+# Labels derived from each Netbox device. Every mapping turns the related Netbox
+# object(s) of a device attribute into a Kentik label:
+#   attribute: one of NETBOX_ATTRIBUTES (tenant, site, role, platform or tags)
+#   name, description: label name and description, "{name}", "{slug}" and "{id}"
+#     are replaced by those fields of the related object
+#   color: label color
+# A device gets the labels of all mappings. Labels that no mapping can produce are
+# left alone. Override with --mappings, a JSON file holding a list like this one.
+LABEL_MAPPINGS = [
+    {"attribute": "tenant", "name": "{name}", "description": "Tenant from netbox for team {name}", "color": "#033a63"},
+    # {"attribute": "site", "name": "site:{slug}", "description": "Netbox site {name}", "color": "#5b8c2a"},
+    # {"attribute": "role", "name": "role:{slug}", "description": "Netbox device role {name}", "color": "#8c2a5b"},
+    # {"attribute": "platform", "name": "platform:{slug}", "description": "Netbox platform {name}", "color": "#2a5b8c"},
+    # {"attribute": "tags", "name": "{name}", "description": "Netbox tag {name}", "color": "#8c5b2a"},
+]
+LABEL_COLOR = "#033a63"
+# Netbox device attributes a mapping can use:
+#   field: device field holding the related object (a list for tags)
+#   endpoint: list endpoint of the related objects
+#   filter: device filter selecting the devices of one related object
+#   object_type: type of the related objects in the change log
+# Netbox versions before 3.6 call the role field device_role.
+NETBOX_ATTRIBUTES = {
+    "tenant": {"field": "tenant", "endpoint": "api/tenancy/tenants/", "filter": "tenant_id", "object_type": "tenancy.tenant"},
+    "site": {"field": "site", "endpoint": "api/dcim/sites/", "filter": "site_id", "object_type": "dcim.site"},
+    "role": {"field": "role", "endpoint": "api/dcim/device-roles/", "filter": "role_id", "object_type": "dcim.devicerole"},
+    "platform": {"field": "platform", "endpoint": "api/dcim/platforms/", "filter": "platform_id", "object_type": "dcim.platform"},
+    "tags": {"field": "tags", "endpoint": "api/extras/tags/", "filter": "tag_id", "object_type": "extras.tag"},
+}
+# Local copy of the Netbox devices, re-fetched after the TTL.
+NETBOX_CACHE_PATH = os.path.join(CACHE_DIR, "netbox-devices.json")
+NETBOX_CACHE_TTL = DEFAULT_TTL
+# Number of labels created and device label updates sent concurrently.
+LABEL_WORKERS = 8
+# Number of changed devices re-read from Netbox per request in --daemon mode.
+NETBOX_ID_BATCH_SIZE = 100
+# --daemon: seconds between reads of the Netbox change log, file holding the id of
+# the last change handled, and seconds between full syncs run as a safety net.
+DAEMON_POLL_INTERVAL = 5
+DAEMON_STATE_PATH = os.path.join(CACHE_DIR, "netbox-label-sync.json")
+FULL_SYNC_INTERVAL = 24 * 3600
+# Secret configured on the Netbox webhook, used to check the X-Hook-Signature header.
+NETBOX_WEBHOOK_SECRET = os.getenv('NETBOX_WEBHOOK_SECRET')
+# Pooled, keep-alive clients shared by every request this script makes.
+KENTIK_CLIENT = KentikClient(KENTIK_API_EMAIL, KENTIK_API_TOKEN, base_url=KENTIK_API_BASE_URL)
+NETBOX_CLIENT = ApiClient(NETBOX_BASE_URL or "", headers=NETBOX_HEADERS, pool_maxsize=NETBOX_WORKERS)
+# Local mirror of the Kentik inventory so labels aren't downloaded on every run.
+INVENTORY = InventoryCache(KENTIK_CLIENT)
 
 def gather_kentik_labels():
-    """Gather the current list of labels"""
+    """Gather the current list of labels, indexed by lowercase label name, or None on error"""
     print("Gathering a list of Kentik Labels")
-    url = f"{KENTIK_API_BASE_URL}/label/v202210/labels"
-    payload = {}
-    headers = KENTIK_HEADERS
-    label_data = {}
+    label_data = {"labels": []}
     try:
-        response = requests.request(
-            "GET", url, headers=headers, data=payload, timeout=30
-        )
-        if response.status_code == 200:
-            label_data = response.json()
-        else:
-            print(f"ERROR, received a {response.status_code} status code")
-            sys.exit(1)
-    except ConnectionError as exc:
+        label_data["labels"] = INVENTORY.list("labels")
+    except requests.exceptions.HTTPError as exc:
+        print(f"ERROR, received a {exc.response.status_code} status code")
+        return None
+    except requests.exceptions.RequestException as exc:
         print(f"ERROR: Connection Error gather labels with message: {exc}")
+        return None
     label_dict = {}
     for label in label_data["labels"]:
-        label_dict[label["name"]] = label["id"]
+        label_dict[label["name"].lower()] = str(label["id"])
     return label_dict
 
-def gather_netbox_tenants():
-    '''Gather a list of netbox tenatns'''
-    print("Gathering a list of Netbox Tenants")
-    # Define the API endpoint for tenants
-    api_endpoint = f"{NETBOX_BASE_URL}/api/tenancy/tenants/"
+def gather_kentik_devices(refresh=False):
+    """Gather the Kentik devices once, indexed by lowercase device name, or None on error"""
+    print("Gathering a list of Kentik Devices")
+    try:
+        devices = INVENTORY.list("devices", refresh)
+    except requests.exceptions.HTTPError as exc:
+        print(f"ERROR, received a {exc.response.status_code} status code")
+        return None
+    except requests.exceptions.RequestException as exc:
+        print(f"ERROR: Connection Error gathering devices with message: {exc}")
+        return None
+    return {device['deviceName'].lower(): device for device in devices if device.get('deviceName')}
 
-    # Set up the headers for the API request, including the authorization token
-    headers = NETBOX_HEADERS
+def netbox_get_all(api_endpoint, params=None):
+    """
+    Gathers every object of a NetBox list endpoint. The first page gives the total
+    count, the remaining limit/offset pages are then fetched concurrently.
+    """
+    params = dict(params or {}, limit=NETBOX_PAGE_SIZE)
+    response = NETBOX_CLIENT.get(api_endpoint, params=dict(params, offset=0))
+    response.raise_for_status()
+    data = response.json()
+    results = data.get("results", [])
+    count = data.get("count") or 0
+    # NetBox caps the page size (MAX_PAGE_SIZE), so page by what it actually returned.
+    page_size = len(results)
+    if not page_size or count <= page_size:
+        return results
 
-    try:
-        # Make the GET request to the NetBox API
-        print(f"Attempting to connect to {api_endpoint}...")
-        response = requests.get(api_endpoint, headers=headers, timeout=10)
+    def get_page(offset):
+        page = NETBOX_CLIENT.get(api_endpoint, params=dict(params, limit=page_size, offset=offset))
+        page.raise_for_status()
+        return page.json().get("results", [])
 
-        # Raise an exception for bad status codes (4xx or 5xx)
-        response.raise_for_status()
+    with ThreadPoolExecutor(max_workers=NETBOX_WORKERS) as executor:
+        for page in executor.map(get_page, range(page_size, count, page_size)):
+            results.extend(page)
+    return results
 
-        # Parse the JSON response and return the 'results' key which contains the list of tenants
-        data = response.json()
-        print("Successfully retrieved tenant data.")
-        return data.get("results", [])
+def load_mappings(path):
+    """Reads label mappings from a JSON file, exiting if they are not valid."""
+    with open(path, "r") as mapping_file:
+        mappings = json.load(mapping_file)
+    for mapping in mappings:
+        if mapping.get("attribute") not in NETBOX_ATTRIBUTES or not mapping.get("name"):
+            print(f"ERROR: Invalid label mapping {mapping}, it needs a name and one of the attributes {list(NETBOX_ATTRIBUTES)}")
+            sys.exit(1)
+    return mappings
 
-    except requests.exceptions.RequestException as e:
-        # Catch any request-related errors (e.g., network issues, invalid URL)
-        print(f"An error occurred: {e}")
-        return None
-    except json.JSONDecodeError:
-        # Catch errors if the response is not valid JSON
-        print("Error: Failed to decode JSON response.")
-        return None
+class _ObjectFields(dict):
+    """Fields of a Netbox object for str.format_map, blank when the object lacks one."""
+    def __missing__(self, key):
+        return ""
 
-def get_devices_by_tenant(tenant):
-    '''Gather device from netbox by tenant'''
-    print(f"Gathering a list of devices for tenant {tenant['name']}")
-    # Define the API endpoint for devices with a filter for tenant ID
-    api_endpoint = f"{NETBOX_BASE_URL}/api/dcim/devices/?tenant_id={tenant['id']}"
+def _related_objects(device, mapping):
+    """Returns the Netbox objects a mapping derives labels from on a device."""
+    value = device.get(NETBOX_ATTRIBUTES[mapping['attribute']]['field'])
+    if not value:
+        return []
+    return value if isinstance(value, list) else [value]
 
-    # Set up the headers for the API request, including the authorization token
-    headers = NETBOX_HEADERS
-    
-    try:
-        # Make the GET request to the NetBox API
-        print(f"Attempting to connect to {api_endpoint}...")
-        response = requests.get(api_endpoint, headers=headers, timeout=10)
+def mapped_label(mapping, netbox_object):
+    """Returns the (name, description, color) of the label a mapping derives from a Netbox object."""
+    fields = _ObjectFields(netbox_object)
+    return (
+        mapping['name'].format_map(fields),
+        mapping.get('description', "").format_map(fields),
+        mapping.get('color', LABEL_COLOR),
+    )
 
-        # Raise an exception for bad status codes (4xx or 5xx)
-        response.raise_for_status()
+def device_labels(device, mappings):
+    """Returns {lowercase label name: (name, description, color)} of the labels a Netbox device should have."""
+    labels = {}
+    for mapping in mappings:
+        for netbox_object in _related_objects(device, mapping):
+            label = mapped_label(mapping, netbox_object)
+            if label[0]:
+                labels.setdefault(label[0].lower(), label)
+    return labels
 
-        # Parse the JSON response and return the 'results' key
-        data = response.json()
-        print(f"Successfully retrieved device data for tenant ID {tenant['name']}.")
-        return data.get("results", [])
+def gather_mapped_label_names(mappings):
+    '''
+    Returns the lowercase names of every label the mappings can produce, from the
+    full list of each mapped Netbox object type, or None on error. Labels with
+    these names are the ones the sync manages.
+    '''
+    names = set()
+    for attribute in dict.fromkeys(mapping['attribute'] for mapping in mappings):
+        api_endpoint = f"{NETBOX_BASE_URL}/{NETBOX_ATTRIBUTES[attribute]['endpoint']}"
+        print(f"Gathering a list of Netbox {attribute} from {api_endpoint}...")
+        try:
+            netbox_objects = netbox_get_all(api_endpoint, {"brief": "true"})
+        except requests.exceptions.RequestException as e:
+            print(f"An error occurred: {e}")
+            return None
+        for mapping in mappings:
+            if mapping['attribute'] == attribute:
+                names.update(mapped_label(mapping, netbox_object)[0].lower() for netbox_object in netbox_objects)
+    names.discard("")
+    return names
 
+def netbox_device_params(mappings):
+    """
+    Returns the device list parameters: only the mapped fields. Devices without
+    them are listed too, so a device whose tenant was cleared loses its label.
+    """
+    fields = ["id", "name"] + list(dict.fromkeys(NETBOX_ATTRIBUTES[mapping['attribute']]['field'] for mapping in mappings))
+    return {"fields": ",".join(fields)}
+
+def gather_netbox_devices(mappings, refresh=False):
+    '''
+    Gather every Netbox device with the mapped fields in one paged sweep. The
+    result is cached locally for NETBOX_CACHE_TTL seconds.
+    '''
+    params = netbox_device_params(mappings)
+    if not refresh:
+        try:
+            with open(NETBOX_CACHE_PATH, "r") as cache_file:
+                cache = json.load(cache_file)
+            if (cache.get("url") == NETBOX_BASE_URL and cache.get("params") == params
+                    and time.time() - cache.get("fetched_at", 0) < NETBOX_CACHE_TTL):
+                print("Using the cached Netbox device list")
+                return cache["devices"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+    print("Gathering a list of all Netbox devices")
+    api_endpoint = f"{NETBOX_BASE_URL}/api/dcim/devices/"
+    try:
+        devices = netbox_get_all(api_endpoint, params)
     except requests.exceptions.RequestException as e:
-        # Catch any request-related errors (e.g., network issues, invalid URL)
         print(f"An error occurred: {e}")
         return None
-    except json.JSONDecodeError:
-        # Catch errors if the response is not valid JSON
-        print("Error: Failed to decode JSON response.")
-        return None
+    print(f"Successfully retrieved {len(devices)} devices.")
+    os.makedirs(os.path.dirname(NETBOX_CACHE_PATH), exist_ok=True)
+    with open(NETBOX_CACHE_PATH, "w") as cache_file:
+        json.dump({"url": NETBOX_BASE_URL, "params": params, "fetched_at": time.time(), "devices": devices}, cache_file)
+    return devices
 
-def compare_label(kentik_label_list, label):
-    """Check to see if the label already exists"""
-    print(f"Checking that {label['name']} exists")
-    if label['name'] in kentik_label_list:
-        print(f"Label {label['name']} exists")
-        function_return = kentik_label_list[label['name']]
-    else:
-        print(f"Creating label, {label['name']}")
-        function_return = create_label(label['name'])
-    return function_return
+def get_devices(mappings, filters):
+    '''Gather the Netbox devices matching the filters, with the mapped fields'''
+    api_endpoint = f"{NETBOX_BASE_URL}/api/dcim/devices/"
+    params = dict(netbox_device_params(mappings), **filters)
+    try:
+        return netbox_get_all(api_endpoint, params)
+    except requests.exceptions.RequestException as e:
+        print(f"An error occurred: {e}")
+        return None
 
-def create_label(label):
-    """Creates a label"""
-    url = f"{KENTIK_API_BASE_URL}/label/v202210/labels"
+def create_label(name, description="", color=LABEL_COLOR):
+    """Creates a label and returns its id, or None on failure"""
+    url = "label/v202210/labels"
     payload = json.dumps({
         "label": {
-            "name": label,
-            "description": f"Tenant from netbox for team {label}",
-            "color": "#033a63"
+            "name": name,
+            "description": description,
+            "color": color
             }
         })
-    headers = KENTIK_HEADERS
-    function_return = ''
+    function_return = None
     try:
-        response = requests.request(
-            "POST", url, headers=headers, data=payload, timeout=30
-        )
-        label_data = response.json()
+        response = KENTIK_CLIENT.request("POST", url, data=payload)
         if response.status_code == 200:
-            function_return = label_data["label"]["id"]
+            label_data = response.json()
+            function_return = str(label_data["label"]["id"])
+            INVENTORY.upsert("labels", label_data["label"])
         else:
             print(response.text)
-    except ConnectionError as exc:
-       print(f"ERROR: Connection error when creating the label - {exc}")
+    except requests.exceptions.ConnectionError as exc:
+        print(f"ERROR: Connection error when creating the label - {exc}")
     return function_return
 
-def check_device(device_name):
-    """Function to check if the device exists in kentik"""
-    print(f"Checking if Device, {device_name} exists...")
-    if REGION == "EU":
-        url = f"https://api.kentik.eu/api/v5/device/{device_name}"
-    else:
-        url = f"https://api.kentik.com/api/v5/device/{device_name}"
-    headers = KENTIK_HEADERS
-    payload = {}
-    response = http_request_func("GET", url, headers, payload)
-    if response:
-        device_info = response.json()
-    else:
-        device_info = False
-        print(f"Device, {device_name}, does not exist")
-    return device_info
-
-def update_device_labels(device_data, label):
-    """Function to add or update device labels"""
-    print("Updating Device Labels...")
-    device_id = device_data['device']['id']
-    device_labels = device_data['device']['labels']
-    url = f"{KENTIK_API_BASE_URL}/device/{API_VERSION}/device/{device_id}/labels"
-    headers = KENTIK_HEADERS
-    labels_list = []
-    device_data = ''
-    for label in device_labels:
-        label_dict = {"id": int(label)}
-        labels_list.append(label_dict)
-    labels_list.append(label)
-    payload = json.dumps({"id": device_id, "labels": labels_list})
-    response = http_request_func("PUT", url, headers, payload)
-    device_data = response.json()
-    return device_data["device"]["id"]
-
-def http_request_func(method, url, headers, payload, retries=0):
-    """Function for handling HTTP Requests"""
-    if retries < 3:
+def create_missing_labels(label_index, labels):
+    """
+    Creates the labels of `labels` ({lowercase name: (name, description, color)})
+    that are not in `label_index` yet, once each and concurrently, and adds them
+    to the index.
+    """
+    missing = sorted(name for name in labels if name not in label_index)
+    if not missing:
+        return
+    print(f"Creating {len(missing)} labels")
+    with ThreadPoolExecutor(max_workers=LABEL_WORKERS) as executor:
+        created = list(executor.map(lambda name: create_label(*labels[name]), missing))
+    for name, label_id in zip(missing, created):
+        if label_id:
+            label_index[name] = label_id
+        else:
+            print(f"ERROR: Could not create the label {labels[name][0]}")
+
+def set_device_labels(device, label_ids):
+    """Replaces the labels of a Kentik device with one PUT. Returns True on success."""
+    name = device['deviceName']
+    labels_list = [{"id": int(label_id)} for label_id in label_ids]
+    payload = json.dumps({"id": device['id'], "labels": labels_list})
+    url = f"device/{API_VERSION}/device/{device['id']}/labels"
+    try:
+        response = KENTIK_CLIENT.request("PUT", url, data=payload)
+    except requests.exceptions.ConnectionError as exc:
+        print(f"ERROR: Connection error when setting the labels of {name} - {exc}")
+        return False
+    if response.status_code != 200:
+        print(f"ERROR: Could not set the labels of {name}, received a {response.status_code} status code: {response.text}")
+        return False
+    print(f"Labels of device, {name}, set to {sorted(str(label_id) for label_id in label_ids)}.")
+    device['labels'] = labels_list
+    INVENTORY.upsert("devices", device)
+    return True
+
+def desired_label_ids(kentik_device, managed, assigned):
+    """
+    Returns the sorted label ids a Kentik device should have, or None if it already
+    has them. `managed` are the ids of the labels the mappings produce and
+    `assigned` the ones the device should have. Other labels are kept.
+    """
+    current_ids = {str(label['id'] if isinstance(label, dict) else label) for label in kentik_device.get('labels') or []}
+    desired_ids = (current_ids - set(managed)) | set(assigned)
+    removed, added = diff_ids(desired_ids, current_ids)
+    return sorted(desired_ids) if removed or added else None
+
+def plan_device_labels(kentik_devices, netbox_devices, mappings, label_index, managed, only=None, prune=False):
+    """
+    Computes the label sets of Kentik devices from the Netbox devices of the same
+    name, creating the labels that don't exist yet in one batch first. Only the
+    managed labels of a matched device are added or replaced. Kentik devices with
+    no Netbox device are left alone, unless `prune` is set, then they lose their
+    managed labels. With `only` (lowercase device names), just those devices are
+    considered. Netbox devices without a name are skipped.
+    Returns [(device, desired label ids)] for the devices whose labels differ.
+    """
+    labels_by_device = {}
+    for device in netbox_devices:
+        if not device.get('name'):
+            continue
+        if device['name'].lower() not in kentik_devices:
+            print(f"Device, {device['name']}, does not exist")
+            continue
+        labels_by_device.setdefault(device['name'].lower(), {}).update(device_labels(device, mappings))
+    all_labels = {}
+    for labels in labels_by_device.values():
+        all_labels.update(labels)
+    create_missing_labels(label_index, all_labels)
+    managed = set(managed) | {label_index[name] for name in all_labels if name in label_index}
+    updates = []
+    for name, kentik_device in kentik_devices.items():
+        if only is not None and name not in only:
+            continue
+        if name not in labels_by_device and not prune:
+            continue
+        assigned = {label_index[label] for label in labels_by_device.get(name, {}) if label in label_index}
+        desired_ids = desired_label_ids(kentik_device, managed, assigned)
+        if desired_ids is not None:
+            updates.append((kentik_device, desired_ids))
+    return updates
+
+def apply_label_updates(updates):
+    """Sends the label updates through a pool of LABEL_WORKERS threads."""
+    with ThreadPoolExecutor(max_workers=LABEL_WORKERS) as executor:
+        results = list(executor.map(lambda update: set_device_labels(*update), updates))
+    print(f"Updated the labels of {results.count(True)} devices, {results.count(False)} failed.")
+
+def managed_label_ids(mappings, label_index):
+    """Returns the ids of the existing labels the mappings can produce, or None on error."""
+    names = gather_mapped_label_names(mappings)
+    if names is None:
+        return None
+    return {label_index[name] for name in names if name in label_index}
+
+def full_sync(mappings, refresh=False, prune=False):
+    """
+    Reconciles the labels of every Kentik device with one pull of the Netbox
+    devices. Returns the managed label ids, or None if Netbox or Kentik could not
+    be read.
+    """
+    label_index = gather_kentik_labels()
+    kentik_devices = gather_kentik_devices(refresh)
+    if label_index is None or kentik_devices is None:
+        return None
+    managed = managed_label_ids(mappings, label_index)
+    netbox_devices = gather_netbox_devices(mappings, refresh)
+    if managed is None or netbox_devices is None:
+        return None
+    updates = plan_device_labels(kentik_devices, netbox_devices, mappings, label_index, managed, prune=prune)
+    print(f"{len(updates)} of {len(kentik_devices)} devices need a label update")
+    apply_label_updates(updates)
+    return managed
+
+# --- Daemon mode ---
+
+def change_log_endpoint():
+    """
+    Returns (change log URL, id of the newest change). NetBox 4.1 moved the change
+    log from extras to core, the older location is used if the new one is missing.
+    """
+    for path in ("api/core/object-changes/", "api/extras/object-changes/"):
+        api_endpoint = f"{NETBOX_BASE_URL}/{path}"
+        response = NETBOX_CLIENT.get(api_endpoint, params={"ordering": "-id", "limit": 1})
+        if response.status_code == 404:
+            continue
+        response.raise_for_status()
+        results = response.json().get("results", [])
+        return api_endpoint, results[0]['id'] if results else 0
+    raise RuntimeError(f"No Netbox change log found at {NETBOX_BASE_URL}")
+
+def load_daemon_state(path=DAEMON_STATE_PATH):
+    """Returns the state saved by the daemon for this Netbox, or an empty state."""
+    try:
+        with open(path, "r") as state_file:
+            state = json.load(state_file)
+        if state.get("url") == NETBOX_BASE_URL:
+            return state
+    except (FileNotFoundError, ValueError):
+        pass
+    return {"url": NETBOX_BASE_URL, "last_change_id": None, "full_sync_at": 0}
+
+def save_daemon_state(state, path=DAEMON_STATE_PATH):
+    """Writes the state to a temporary file first, so a crash never leaves a half written file."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(temp_path, path)
+
+def _snapshot_value(value):
+    """
+    Change log snapshots hold related objects as an id (tags as a list of names),
+    API objects as a dict.
+    """
+    if isinstance(value, list):
+        return sorted(str(_snapshot_value(item)) for item in value)
+    return value.get('id') if isinstance(value, dict) else value
+
+def label_changes(changes, mappings):
+    """
+    Returns (ids of the devices to re-read, lowercase names of the devices to
+    reconcile, {(attribute, object id)} of mapped objects created or renamed) for
+    the changes that can affect labels. Other changes are ignored. The names cover
+    devices deleted, renamed away or no longer matching the device listing.
+    """
+    fields = ["name"] + [NETBOX_ATTRIBUTES[mapping['attribute']]['field'] for mapping in mappings]
+    object_types = {NETBOX_ATTRIBUTES[mapping['attribute']]['object_type']: mapping['attribute'] for mapping in mappings}
+    device_ids = set()
+    names = set()
+    renamed = set()
+    for change in changes:
+        action = change['action']['value'] if isinstance(change['action'], dict) else change['action']
+        before = change.get('prechange_data') or {}
+        after = change.get('postchange_data') or {}
+        if change['changed_object_type'] == "dcim.device":
+            if action == "delete":
+                if before.get('name'):
+                    names.add(before['name'].lower())
+            elif any(_snapshot_value(before.get(field)) != _snapshot_value(after.get(field)) for field in fields):
+                device_ids.add(change['changed_object_id'])
+                names.update(snapshot['name'].lower() for snapshot in (before, after) if snapshot.get('name'))
+        elif change['changed_object_type'] in object_types:
+            if action == "create" or any(before.get(field) != after.get(field) for field in ("name", "slug")):
+                renamed.add((object_types[change['changed_object_type']], change['changed_object_id']))
+    return device_ids, names, renamed
+
+def apply_changes(changes, mappings, label_index, managed, prune=False):
+    """
+    Applies the label updates for a batch of change log entries. `label_index` is
+    updated with the labels created and `managed` collects every managed label id
+    seen, so a label a renamed object no longer produces is removed as well.
+    Returns False if Netbox or Kentik could not be read.
+    """
+    device_ids, names, renamed = label_changes(changes, mappings)
+    if not device_ids and not names and not renamed:
+        return True
+    netbox_devices = []
+    device_ids = sorted(device_ids)
+    for start in range(0, len(device_ids), NETBOX_ID_BATCH_SIZE):
+        devices = get_devices(mappings, {"id": device_ids[start:start + NETBOX_ID_BATCH_SIZE]})
+        if devices is None:
+            return False
+        netbox_devices.extend(devices)
+    if renamed:
+        label_ids = managed_label_ids(mappings, label_index)
+        if label_ids is None:
+            return False
+        managed.update(label_ids)
+        # The devices of a renamed object get the label of its new name.
+        for attribute, object_id in sorted(renamed):
+            devices = get_devices(mappings, {NETBOX_ATTRIBUTES[attribute]['filter']: object_id})
+            if devices is None:
+                return False
+            netbox_devices.extend(devices)
+    only = names | {device['name'].lower() for device in netbox_devices if device.get('name')}
+    kentik_devices = gather_kentik_devices()
+    if kentik_devices is not None and any(name not in kentik_devices for name in only):
+        # The device may have been added to Kentik since the cache was refreshed.
+        kentik_devices = gather_kentik_devices(refresh=True)
+    if kentik_devices is None:
+        return False
+    updates = plan_device_labels(kentik_devices, netbox_devices, mappings, label_index, managed, only, prune)
+    managed.update(label_index[name] for device in netbox_devices for name in device_labels(device, mappings) if name in label_index)
+    print(f"{len(changes)} Netbox changes, {len(updates)} devices need a label update")
+    apply_label_updates(updates)
+    return True
+
+def start_webhook_receiver(port, wake):
+    """
+    Listens for NetBox webhooks on `port` and sets `wake` for each one, so the
+    change log is read right away instead of at the next poll. If
+    NETBOX_WEBHOOK_SECRET is set, requests without a matching X-Hook-Signature are
+    refused.
+    """
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if NETBOX_WEBHOOK_SECRET:
+                signature = hmac.new(NETBOX_WEBHOOK_SECRET.encode(), body, hashlib.sha512).hexdigest()
+                if not hmac.compare_digest(signature, self.headers.get("X-Hook-Signature", "")):
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+            self.send_response(204)
+            self.end_headers()
+            wake.set()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), WebhookHandler)
+    threading.Thread(target=server.serve_forever, name="netbox-webhooks", daemon=True).start()
+    print(f"Listening for Netbox webhooks on port {server.server_address[1]}")
+    return server
+
+def run_daemon(mappings, poll_interval=DAEMON_POLL_INTERVAL, state_path=DAEMON_STATE_PATH, webhook_port=None,
+               full_sync_interval=FULL_SYNC_INTERVAL, prune=False):
+    """
+    Follows the Netbox change log from the last change handled and applies the
+    label updates of device and mapped object changes as they happen. A full sync
+    runs on the first start and every `full_sync_interval` seconds as a safety net.
+    """
+    state = load_daemon_state(state_path)
+    wake = threading.Event()
+    if webhook_port is not None:
+        start_webhook_receiver(webhook_port, wake)
+    label_index = None
+    managed = set()
+    api_endpoint = None
+    print(f"Following the Netbox change log every {poll_interval}s...")
+    while True:
         try:
-            response = requests.request(
-                method, url, headers=headers, data=payload, timeout=30
-            )
-            if response.status_code == 200:
-                print("%s HTTP Request Successfull for url: %s", method, url)
-            elif response.status_code == 429:
-                if 'x-ratelimit-reset' in response.headers:
-                    time.sleep(int(response.headers['x-ratelimit-reset']))
+            if api_endpoint is None:
+                api_endpoint, latest_id = change_log_endpoint()
+                if state['last_change_id'] is None:
+                    state['last_change_id'] = latest_id
+                    state['full_sync_at'] = 0
+            if time.time() - state['full_sync_at'] >= full_sync_interval:
+                synced = full_sync(mappings, refresh=True, prune=prune)
+                if synced is not None:
+                    managed.update(synced)
+                    label_index = None
+                    state['full_sync_at'] = time.time()
+                    save_daemon_state(state, state_path)
+            if label_index is None:
+                # A failed read stays None, so it is retried on the next poll.
+                label_index = gather_kentik_labels()
+                label_ids = managed_label_ids(mappings, label_index) if label_index is not None else None
+                if label_ids is None:
+                    label_index = None
                 else:
-                    time.sleep(60)
-                retries += 1
-                http_request_func(method, url, headers, payload, retries)
-            elif response.status_code == 404:
-                return False
-            else:
-                print(response.text)
-            if 'x-ratelimit-remaining' in response.headers:
-                if int(response.headers['x-ratelimit-remaining']) < 10:
-                    time.sleep(10)  # Helps to slow down the rate of execution for throttling.
-        except ConnectionError as exc:
-            print(f"ERROR: Connection error when attaching the label - {exc}")
-    else:
-        print("ERROR - RETRIED 3 TIMES")
-    return response
-
-def main():
+                    managed.update(label_ids)
+            if label_index is not None:
+                changes = netbox_get_all(api_endpoint, {"id__gt": state['last_change_id'], "ordering": "id"})
+                changes.sort(key=lambda change: change['id'])
+                if changes and apply_changes(changes, mappings, label_index, managed, prune):
+                    state['last_change_id'] = changes[-1]['id']
+                    save_daemon_state(state, state_path)
+        except (requests.exceptions.RequestException, RuntimeError) as exc:
+            print(f"ERROR: {exc}")
+        wake.wait(poll_interval)
+        wake.clear()
+
+def main(mappings=LABEL_MAPPINGS, refresh=False, prune=False):
     '''MAIN FUNCTION PROGRAM STARTS HERE'''
     print("Starting the label sync program for Kentik and Netbox")
-    kentik_label_list = gather_kentik_labels()
-    print(kentik_label_list)
-    netbox_tenant_list = gather_netbox_tenants()
-    for label in netbox_tenant_list:
-        label_id = compare_label(kentik_label_list, label)
-        device_list = get_devices_by_tenant(label)
-        for device in device_list:
-            device_data = check_device(device['name'])
-            if device_data:
-                update_device_labels(device_data, label_id)
-                print(f"Label, {label['name']}, associated to device, {device['name']}.")
+    if full_sync(mappings, refresh, prune) is None:
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mappings", help="JSON file with the label mappings to use instead of LABEL_MAPPINGS.")
+    parser.add_argument("--refresh", action="store_true", help="Re-download the Kentik and Netbox devices instead of using the local cache.")
+    parser.add_argument("--prune", action="store_true", help="Also remove the mapped labels from Kentik devices that have no Netbox device of the same name.")
+    parser.add_argument("--daemon", action="store_true", help="Keep running, applying Netbox changes from the change log as they happen.")
+    parser.add_argument("--poll-interval", type=float, default=DAEMON_POLL_INTERVAL, help="Seconds between reads of the Netbox change log in --daemon mode.")
+    parser.add_argument("--state", default=DAEMON_STATE_PATH, help="File holding the id of the last Netbox change handled in --daemon mode.")
+    parser.add_argument("--webhook-port", type=int, help="In --daemon mode, also listen for Netbox webhooks on this port and read the change log as soon as one arrives.")
+    parser.add_argument("--full-sync-interval", type=float, default=FULL_SYNC_INTERVAL, help="Seconds between full syncs in --daemon mode.")
+    args = parser.parse_args()
+    mappings = load_mappings(args.mappings) if args.mappings else LABEL_MAPPINGS
+    if args.daemon:
+        run_daemon(mappings, args.poll_interval, args.state, args.webhook_port, args.full_sync_interval, args.prune)
+    main(mappings, refresh=args.refresh, prune=args.prune)
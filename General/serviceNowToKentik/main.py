@@ -1,201 +1,751 @@
 # The goal of this program is to read in a csv file with strings that should be in interface descriptions
 #  and add a device Id and an interface id to the spreadsheet
+#
+# By default the workbooks are loaded whole, the output template is filled in and the
+# notes are written back into circuits.xlsx. With --stream the workbooks are read row by
+# row (read only), the output is written with a write only workbook and the notes go to a
+# separate results file, so memory stays flat for large circuit inventories.
+# With --columnar the circuit checks run as vectorized rules over the whole sheet.
+# With --push the matched circuits are also sent straight to the Kentik connectivity
+# cost API as cost groups, skipping the ones that did not change.
+# With --servicenow the circuits are fetched from the ServiceNow Table API instead of
+# circuits.xlsx, only the ones updated since the previous run.
+# With --kentik-interfaces the circuits are matched against the live Kentik interfaces
+# instead of interfaces.xlsx.
 
+import argparse
+import csv
+import json
+import os
+import sys
 import openpyxl
+import requests
 import datetime
 from dateutil.relativedelta import relativedelta
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-# open the interfaces workbook
-interfaces_workbook = openpyxl.load_workbook('./interfaces.xlsx')
-
-# grab the active worksheet
-interfaces_ws = interfaces_workbook.active
-
-# open the circuit information workbook
-circuit_workbook = openpyxl.load_workbook('./circuits.xlsx')
-# open the circuit worksheet
-circuit_ws = circuit_workbook.active
-# open the output information workbook
-output_workbook = openpyxl.load_workbook('./connectivit_costs_bulk_import.xlsx')
-# open the output worksheet
-output_ws = output_workbook.active
-# set the new row integer
-c_number = 2
-# iterate through the cells in the circuit spreadsheet and assign variables for key items
-for row in circuit_ws.iter_rows(min_row=2,min_col=7,max_col=7):
-    for cell in row:
-        # notes cell for this row
-        c_notes = circuit_ws.cell(row = cell.row, column = 15)
-        # used to search the interface descriptions for a match
-        circuit_id = str(circuit_ws.cell(row=cell.row, column=8).value)
-        # used to pick the A side of the interface
-        source_site_name = circuit_ws.cell(row=cell.row, column=1).value
-        # used to filter out non point to point circuits
-        connect_type = circuit_ws.cell(row=cell.row, column=3).value
-        # used to get the bandwidth of the connection
-        circuit_type = circuit_ws.cell(row=cell.row, column=5).value
-        commit_bandwidth = circuit_ws.cell(row=cell.row, column=10).value
-        match = re.search(r'(\d+\.?\d*)', str(commit_bandwidth))
-        if match:
-            bandwidth = match.group(1)
-        else:
-            bandwidth = 0
-            c_notes.value = "Commit Bandwidth incorrect"
-        #if circuit_type is None:
-        #    c_notes.value = "circuit type was blank"
-        #    continue
-        #if circuit_type.find("1G") > -1:
-        #    bandwidth = 1
-        #elif circuit_type.find("10G") > -1:
-        #    bandwidth = 10
-        #elif circuit_type.find("100G") > -1:
-        #    bandwidth = 100
-        # used for provider selection
-        provider_name = circuit_ws.cell(row=cell.row, column=6).value
-        # currency used in output
-        currency = circuit_ws.cell(row=cell.row, column=13).value
-        if currency == "$":
-            currency = "USD"
-        elif currency == "€":
-            currency = "EUR"
-        # service start state
-        start_date = circuit_ws.cell(row=cell.row, column=11).value
-        if start_date is None:
-            c_notes.value = "In service start date was blank."
-            continue
-        # service term
-        term_length = circuit_ws.cell(row=cell.row, column=12).value
-        if term_length is None:
-            c_notes.value = "Term length was blank"
-            continue
-        if term_length == '':
-            c_notes.value = "Term length was blank"
-            continue
-        # contract end date
-        contract_end = datetime.datetime.strptime(str(start_date), '%Y-%m-%d %H:%M:%S') + relativedelta(months=+int(term_length))
-        # circuit name to be used as cost group name
-        cost_group_name = circuit_ws.cell(row=cell.row, column=2).value
-        # mrc - monthly recurring charge
-        monthly_charge = circuit_ws.cell(row=cell.row, column=14).value
-        # Get Price per Mbps
-        price_per = circuit_ws.cell(row=cell.row, column=9).value
-        # ignore blanks
-        if circuit_id is None:
-            c_notes.value = "Circuit ID was blank"
-            continue
-        if circuit_id.find("DCS Internal") > -1:
-            c_notes.value = "DCS Internal"
-            continue
-        if circuit_id.find("cross-connect") > -1:
-            c_notes.value = "Cross connect"
-            continue
-        if connect_type is None:
-            c_notes.value = "Type was blank"
-            continue
-        if source_site_name is None:
-            c_notes.value = "Site name was blank"
-            continue
-        if provider_name is None:
-            c_notes.value = "Provider was blank"
-            continue
-        if monthly_charge is None:
-            c_notes.value = "MRC was blank"
-            continue
-        if monthly_charge == '':
-            c_notes.value = "MRC was blank"
+# Make the shared kentik_common package at the repository root importable.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from kentik_common.client import KENTIK_API_BASE_URL, ApiClient, KentikClient
+from kentik_common.inventory_cache import DEFAULT_TTL, RESOURCES, InventoryCache
+from kentik_common.reconcile import diff_fields, diff_ids, format_changes
+
+INTERFACES_FILE_PATH = './interfaces.xlsx'
+CIRCUITS_FILE_PATH = './circuits.xlsx'
+OUTPUT_TEMPLATE_PATH = './connectivit_costs_bulk_import.xlsx'
+OUTPUT_FILE_PATH = './connectivit_costs_bulk_import_saved.xlsx'
+# notes per circuit row in --stream mode
+RESULTS_FILE_PATH = './circuits_results.csv'
+RESULTS_HEADERS = ['row', 'circuit_id', 'notes']
+
+# number of columns in the circuit sheet (column 15 holds the notes)
+CIRCUIT_COLUMNS = 15
+# number of columns in the output sheet
+OUTPUT_COLUMNS = 17
+
+# Kentik connectivity cost API, used by --push
+KENTIK_API_EMAIL = os.getenv('KENTIK_EMAIL')
+KENTIK_API_TOKEN = os.getenv('KENTIK_TOKEN')
+COST_GROUPS_PATH = "cost/v202308beta1/cost_groups"
+# number of cost groups sent per request and number of requests in flight
+PUSH_BATCH_SIZE = 50
+PUSH_WORKERS = 4
+# Live Kentik interface source, used by --kentik-interfaces: number of devices whose
+# interfaces are fetched concurrently, and interfaces per page (0 fetches a device's
+# interfaces in one request)
+INTERFACE_WORKERS = 8
+INTERFACE_PAGE_SIZE = 0
+
+# ServiceNow Table API, used by --servicenow
+SERVICENOW_URL = os.getenv('SERVICENOW_URL')  # e.g. https://<instance>.service-now.com
+SERVICENOW_USER = os.getenv('SERVICENOW_USER')
+SERVICENOW_PASSWORD = os.getenv('SERVICENOW_PASSWORD')
+SERVICENOW_TABLE = os.getenv('SERVICENOW_TABLE', 'cmdb_ci_circuit')
+# ServiceNow field read into each circuit sheet column, in column order (None for columns not used)
+SERVICENOW_FIELDS = [
+    "location", "name", "type", None, "circuit_type", "vendor", None, "circuit_id", "price_per_mbps",
+    "commit_bandwidth", "install_date", "term", "currency", "monthly_cost", None,
+]
+# fields parsed as dates rather than read as display values
+SERVICENOW_DATE_FIELDS = ("install_date",)
+SERVICENOW_PAGE_SIZE = 1000
+# sys_updated_on of the newest circuit fetched, so the next run only fetches changes
+WATERMARK_FILE_PATH = './servicenow_watermark.json'
+
+# circuit references are written in interface descriptions as ref=<circuit id>.
+# A reference ends at whitespace or at one of , ; |
+REF_PATTERN = re.compile(r'ref=([^\s,;|]+)')
+
+
+def _pad(values, length):
+    """Pads a row of cell values so every column up to `length` exists."""
+    values = tuple(values)
+    return values + (None,) * (length - len(values))
+
+
+def build_interface_refs(interface_rows):
+    """
+    Indexes the interfaces once by circuit reference so each circuit is a dictionary
+    lookup instead of a scan of every interface.
+    Returns ref -> list of (device id, interface id, site) in interface sheet order.
+    """
+    interface_refs = {}
+    for interface_row in interface_rows:
+        # pad short rows so the site column (7) always exists
+        interface_row = _pad(interface_row, 7)
+        # ignore blank descriptions
+        interface_desc = interface_row[4]
+        if interface_desc is None:
             continue
-        if monthly_charge == '0':
-            c_notes.value = "MRC was 0"
+        for ref in REF_PATTERN.findall(str(interface_desc)):
+            interface_refs.setdefault(ref, []).append((interface_row[1], interface_row[2], interface_row[6]))
+    return interface_refs
+
+
+def match_interfaces(circuit_id, connect_type, source_site_name, interface_refs):
+    """
+    Looks up the interfaces that reference a circuit (white space already removed).
+    Returns (device id, interface id) of the A side, B side or Internet interface, or None.
+    """
+    # boolean used to check if interfaces were found
+    interface_bool = False
+    # list of interface ids
+    interface_ids = {}
+    for device_id, interface_id, interface_site in interface_refs.get(circuit_id, []):
+        interface_bool = True
+        if connect_type != "Internet":
+            # see if the site name matches
+            if interface_site is not None and source_site_name.find(str(interface_site)) > -1:
+                interface_ids["aside_device"] = device_id
+                interface_ids["aside_interface"] = interface_id
+            else:
+                interface_ids["bside_device"] = device_id
+                interface_ids["bside_interface"] = interface_id
+        else:
+            interface_ids["internet_device"] = device_id
+            interface_ids["internet_interface"] = interface_id
+
+    if not interface_bool:
+        return None
+    if connect_type == "Internet":
+        return interface_ids["internet_device"], interface_ids["internet_interface"]
+    if "aside_interface" in interface_ids:
+        return interface_ids["aside_device"], interface_ids["aside_interface"]
+    return interface_ids["bside_device"], interface_ids["bside_interface"]
+
+
+def build_output(values, circuit_id, bandwidth, contract_end, device_id, interface_id):
+    """Returns the output row values, by column number, for a matched circuit."""
+    output = [None] * OUTPUT_COLUMNS
+    output[0] = values[4]
+    output[1] = values[5]
+    output[2] = values[1]
+    output[3] = "Commit (Blended)"
+    output[4] = contract_end
+    output[5] = bandwidth
+    output[7] = values[13]
+    output[10] = values[8]
+    currency = values[12]
+    if currency == "$":
+        currency = "USD"
+    elif currency == "€":
+        currency = "EUR"
+    output[11] = currency
+    output[12] = values[7]
+    output[13] = circuit_id
+    output[14] = values[10].day
+    output[15] = interface_id
+    output[16] = device_id
+    return output
+
+
+def process_circuit(values, interface_refs):
+    """
+    Matches one circuit row (a tuple of cell values) to its interfaces.
+    Returns (notes, output row values or None).
+    """
+    values = _pad(values, CIRCUIT_COLUMNS)
+    # used to search the interface descriptions for a match
+    circuit_id = str(values[7])
+    # used to pick the A side of the interface
+    source_site_name = values[0]
+    # used to filter out non point to point circuits
+    connect_type = values[2]
+    # used to get the bandwidth of the connection
+    commit_bandwidth = values[9]
+    match = re.search(r'(\d+\.?\d*)', str(commit_bandwidth))
+    if match:
+        bandwidth = match.group(1)
+    else:
+        bandwidth = 0
+    # used for provider selection
+    provider_name = values[5]
+    # service start state
+    start_date = values[10]
+    if start_date is None:
+        return "In service start date was blank.", None
+    # service term
+    term_length = values[11]
+    if term_length is None:
+        return "Term length was blank", None
+    if term_length == '':
+        return "Term length was blank", None
+    # contract end date
+    contract_end = datetime.datetime.strptime(str(start_date), '%Y-%m-%d %H:%M:%S') + relativedelta(months=+int(term_length))
+    # mrc - monthly recurring charge
+    monthly_charge = values[13]
+    # Get Price per Mbps
+    price_per = values[8]
+    # ignore blanks
+    if circuit_id is None:
+        return "Circuit ID was blank", None
+    if circuit_id.find("DCS Internal") > -1:
+        return "DCS Internal", None
+    if circuit_id.find("cross-connect") > -1:
+        return "Cross connect", None
+    if connect_type is None:
+        return "Type was blank", None
+    if source_site_name is None:
+        return "Site name was blank", None
+    if provider_name is None:
+        return "Provider was blank", None
+    if monthly_charge is None:
+        return "MRC was blank", None
+    if monthly_charge == '':
+        return "MRC was blank", None
+    if monthly_charge == '0':
+        return "MRC was 0", None
+    if price_per == '0':
+        return "Price per Megabit was 0", None
+    if price_per == '':
+        return "Price per Megabit was blank", None
+    # ignore provider name of snow
+    if provider_name.find("SNOW") > -1:
+        return "Provider was SNOW", None
+    # Remove white space in circuit id
+    circuit_id = circuit_id.replace(" ", "")
+    # look up the interfaces that reference the circuit id
+    interface = match_interfaces(circuit_id, connect_type, source_site_name, interface_refs)
+    if interface is None:
+        return "interface was not found", None
+    device_id, interface_id = interface
+    return "Circuit Added", build_output(values, circuit_id, bandwidth, contract_end.strftime("%Y-%m-%d"), device_id, interface_id)
+
+
+def circuit_results(rows, interface_refs):
+    """Checks and matches the circuit rows one at a time. Yields (values, notes, output or None)."""
+    for values in rows:
+        values = _pad(values, CIRCUIT_COLUMNS)
+        notes, output = process_circuit(values, interface_refs)
+        yield values, notes, output
+
+
+def _blank(column):
+    return column.isna() | (column == '')
+
+
+# The checks of process_circuit as vectorized rules, in the order they are applied.
+# A row is rejected with the notes of the first rule whose mask is true for it.
+CIRCUIT_RULES = [
+    ("In service start date was blank.", lambda c: c["start_date"].isna()),
+    ("Term length was blank", lambda c: _blank(c["term_length"])),
+    ("Term length was not a number", lambda c: c["term_months"].isna()),
+    ("In service start date was not a date", lambda c: c["start"].isna()),
+    ("DCS Internal", lambda c: c["circuit_key"].str.contains("DCS Internal", regex=False)),
+    ("Cross connect", lambda c: c["circuit_key"].str.contains("cross-connect", regex=False)),
+    ("Type was blank", lambda c: c["connect_type"].isna()),
+    ("Site name was blank", lambda c: c["site"].isna()),
+    ("Provider was blank", lambda c: c["provider"].isna()),
+    ("MRC was blank", lambda c: _blank(c["monthly_charge"])),
+    ("MRC was 0", lambda c: c["monthly_charge"] == '0'),
+    ("Price per Megabit was 0", lambda c: c["price_per"] == '0'),
+    ("Price per Megabit was blank", lambda c: c["price_per"] == ''),
+    ("Provider was SNOW", lambda c: c["provider"].astype(str).str.contains("SNOW", regex=False)),
+]
+
+# names of the circuit sheet columns, in column order
+CIRCUIT_FIELDS = [
+    "site", "cost_group_name", "connect_type", "column_4", "circuit_type", "provider", "column_7",
+    "circuit_id", "price_per", "commit_bandwidth", "start_date", "term_length", "currency",
+    "monthly_charge", "notes",
+]
+
+
+def add_months(start, months):
+    """
+    Adds a number of months to each date like relativedelta does: the day is
+    clipped to the last day of the resulting month. NaT/NaN give NaT.
+    """
+    import numpy as np
+    import pandas as pd
+    total = start.dt.year * 12 + start.dt.month - 1 + months
+    valid = total.notna()
+    total = total[valid].astype(int)
+    first = pd.to_datetime(pd.DataFrame({"year": total // 12, "month": total % 12 + 1, "day": 1}))
+    day = np.minimum(start[valid].dt.day, first.dt.days_in_month)
+    end = pd.Series(pd.NaT, index=start.index, dtype="datetime64[ns]")
+    end[valid] = first + pd.to_timedelta(day - 1, unit="D")
+    return end
+
+
+def columnar_circuit_results(rows, interface_refs):
+    """
+    Loads every circuit row into a DataFrame and applies CIRCUIT_RULES as vectorized
+    masks, computing the bandwidth and contract end dates in the same pass. Only the
+    rows that pass are matched to interfaces. Prints how many rows each rule rejected.
+    Yields (values, notes, output or None) in sheet order, like circuit_results.
+    Only --columnar needs pandas and numpy, so they are imported here.
+    """
+    import numpy as np
+    import pandas as pd
+
+    records = [_pad(values, CIRCUIT_COLUMNS) for values in rows]
+    circuits = pd.DataFrame(records, columns=CIRCUIT_FIELDS, dtype=object)
+    circuits["circuit_key"] = circuits["circuit_id"].astype(str)
+    circuits["start"] = pd.to_datetime(circuits["start_date"], errors="coerce")
+    circuits["term_months"] = np.trunc(pd.to_numeric(circuits["term_length"], errors="coerce"))
+
+    masks = [rule(circuits).fillna(False).astype(bool).to_numpy() for _, rule in CIRCUIT_RULES]
+    notes = np.select(masks, [rule_notes for rule_notes, _ in CIRCUIT_RULES], default="")
+    accepted = notes == ""
+
+    bandwidth = circuits["commit_bandwidth"].astype(str).str.extract(r'(\d+\.?\d*)', expand=False).fillna(0)
+    contract_end = add_months(circuits["start"].where(accepted), circuits["term_months"].where(accepted))
+    contract_end = contract_end.dt.strftime("%Y-%m-%d")
+
+    # summary of the rejections per rule
+    print(f"Checked {len(circuits)} circuits, {int(accepted.sum())} passed the checks.")
+    for rule_notes, _ in CIRCUIT_RULES:
+        rejected = int((notes == rule_notes).sum())
+        if rejected:
+            print(f"  {rule_notes}: {rejected}")
+
+    not_found = 0
+    for index, values in enumerate(records):
+        if not accepted[index]:
+            yield values, str(notes[index]), None
             continue
-        if price_per == '0':
-            c_notes.value = "Price per Megabit was 0"
+        circuit_id = circuits.at[index, "circuit_key"].replace(" ", "")
+        interface = match_interfaces(circuit_id, values[2], values[0], interface_refs)
+        if interface is None:
+            not_found += 1
+            yield values, "interface was not found", None
             continue
-        if price_per == '':
-            c_notes.value = "Price per Megabit was blank"
+        device_id, interface_id = interface
+        yield values, "Circuit Added", build_output(
+            values, circuit_id, bandwidth.iat[index], contract_end.iat[index], device_id, interface_id
+        )
+    print(f"  interface was not found: {not_found}")
+
+
+def cost_group_payloads(outputs):
+    """
+    Turns the output rows into cost group payloads, keyed by cost group name. Rows
+    sharing a cost group name become one group with all of their interfaces, the
+    other fields are taken from the first row, as the bulk import does.
+    """
+    groups = {}
+    for output in outputs:
+        name = output[2]
+        group = groups.get(name)
+        if group is None:
+            group = groups[name] = {
+                "name": name,
+                "type": output[0],
+                "provider": output[1],
+                "costFormula": output[3],
+                "contractEndDate": output[4],
+                "bandwidth": output[5],
+                "monthlyCharge": output[7],
+                "pricePerMbps": output[10],
+                "currency": output[11],
+                "contractId": output[12],
+                "circuitId": output[13],
+                "billingStartDay": output[14],
+                "interfaces": [],
+            }
+        interface = {"deviceId": str(output[16]), "interfaceId": str(output[15])}
+        if interface not in group["interfaces"]:
+            group["interfaces"].append(interface)
+    return groups
+
+
+def _interface_keys(group):
+    return [f"{interface.get('deviceId')}:{interface.get('interfaceId')}" for interface in group.get("interfaces") or []]
+
+
+def fetch_cost_groups(client):
+    """Returns the existing cost groups keyed by lowercase name."""
+    response = client.get(COST_GROUPS_PATH)
+    response.raise_for_status()
+    return {str(group.get("name")).lower(): group for group in response.json().get("costGroups") or []}
+
+
+def plan_cost_groups(groups, existing, add_only=False):
+    """
+    Compares the cost groups against the existing ones. With `add_only` the
+    interfaces of an existing group are kept and the new ones added to them, for
+    when `groups` was built from only some of the circuits.
+    Returns (groups to create, [(group to update, changes)], number unchanged).
+    """
+    creates = []
+    updates = []
+    unchanged = 0
+    for name, group in groups.items():
+        current = existing.get(str(name).lower())
+        if current is None:
+            creates.append(group)
             continue
-        # ignore provider name of snow
-        if provider_name.find("SNOW") > -1:
-            c_notes.value = "Provider was SNOW"
+        if add_only:
+            interfaces = list(current.get("interfaces") or [])
+            keys = set(_interface_keys(current))
+            interfaces += [interface for interface, key in zip(group["interfaces"], _interface_keys(group)) if key not in keys]
+            group = dict(group, interfaces=interfaces)
+        changes = diff_fields(group, current, ignore=("interfaces",))
+        removed, added = diff_ids(_interface_keys(group), _interface_keys(current))
+        if removed or added:
+            changes["interfaces"] = (removed, added)
+        if changes:
+            updates.append((dict(group, id=current["id"]), changes))
+        else:
+            unchanged += 1
+    return creates, updates, unchanged
+
+
+def _send_cost_groups(client, method, batch):
+    """Sends one batch of cost groups. Returns the number of groups written."""
+    try:
+        response = client.request(method, COST_GROUPS_PATH, json={"costGroups": batch})
+    except requests.exceptions.RequestException as e:
+        print(f"Error sending {len(batch)} cost groups: {e}")
+        return 0
+    if response.status_code not in (200, 201):
+        print(f"Error sending {len(batch)} cost groups: {response.status_code} {response.text}")
+        return 0
+    return len(batch)
+
+
+def push_cost_groups(outputs, client, plan=False, batch_size=PUSH_BATCH_SIZE, workers=PUSH_WORKERS, add_only=False):
+    """
+    Creates and updates the cost groups of the matched circuits through the API.
+    Groups that match the existing cost group are not sent. New groups are POSTed
+    and changed groups PUT, in batches of `batch_size`, `workers` requests at a time.
+    With `add_only`, interfaces are only added to existing groups, see plan_cost_groups.
+    Returns True if every group was sent.
+    """
+    groups = cost_group_payloads(outputs)
+    creates, updates, unchanged = plan_cost_groups(groups, fetch_cost_groups(client), add_only)
+    if plan:
+        for group in creates:
+            print(f"PLAN: CREATE cost group '{group['name']}' ({len(group['interfaces'])} interfaces)")
+        for group, changes in updates:
+            print(f"PLAN: UPDATE cost group '{group['name']}' ({group['id']})\n{format_changes(changes)}")
+        print(f"Cost groups to create: {len(creates)}, to update: {len(updates)}, unchanged: {unchanged}")
+        return True
+    batches = [("POST", creates[i:i + batch_size]) for i in range(0, len(creates), batch_size)]
+    update_groups = [group for group, _ in updates]
+    batches += [("PUT", update_groups[i:i + batch_size]) for i in range(0, len(update_groups), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sent = sum(executor.map(lambda batch: _send_cost_groups(client, *batch), batches))
+    print(f"Cost groups sent: {sent} of {len(creates) + len(updates)} (created {len(creates)}, updated {len(updates)}), unchanged: {unchanged}")
+    return sent == len(creates) + len(updates)
+
+
+def servicenow_client():
+    """Returns a pooled client for the ServiceNow Table API."""
+    client = ApiClient(f"{SERVICENOW_URL}/api/now/table", headers={"Accept": "application/json"})
+    client.session.auth = (SERVICENOW_USER, SERVICENOW_PASSWORD)
+    return client
+
+
+def _servicenow_page(client, params, limit):
+    """Fetches one page of the circuit table."""
+    response = client.get(SERVICENOW_TABLE, params=dict(params, sysparm_limit=limit))
+    response.raise_for_status()
+    return response.json().get("result") or []
+
+
+def fetch_servicenow_circuits(client, since=None, page_size=SERVICENOW_PAGE_SIZE):
+    """
+    Fetches the circuit records, only the ones updated at or after `since` if given.
+    Records are sorted by sys_updated_on, then sys_id, and each page starts after the
+    last (sys_updated_on, sys_id) of the previous one rather than at an offset, so a
+    circuit updated while paging cannot shift a record past a page boundary. The
+    updated circuit is fetched again at its new position, only its newest copy is kept.
+    """
+    order = "ORDERBYsys_updated_on^ORDERBYsys_id"
+    fields = [field for field in SERVICENOW_FIELDS if field] + ["sys_id", "sys_updated_on"]
+    params = {
+        "sysparm_fields": ",".join(fields),
+        "sysparm_display_value": "all",
+        "sysparm_exclude_reference_link": "true",
+    }
+    # >= since rows committed later with the watermark's timestamp would be lost with >
+    query = f"sys_updated_on>={since}^{order}" if since else order
+    records = []
+    while True:
+        page = _servicenow_page(client, dict(params, sysparm_query=query), page_size)
+        records.extend(page)
+        if len(page) < page_size:
+            break
+        updated_on = _servicenow_value(page[-1], "sys_updated_on", raw=True)
+        sys_id = _servicenow_value(page[-1], "sys_id", raw=True)
+        query = f"sys_updated_on>{updated_on}^NQsys_updated_on={updated_on}^sys_id>{sys_id}^{order}"
+    unique = {}
+    for record in records:
+        sys_id = _servicenow_value(record, "sys_id", raw=True)
+        current = unique.get(sys_id)
+        if current is None or (_servicenow_value(record, "sys_updated_on", raw=True) or "") >= (_servicenow_value(current, "sys_updated_on", raw=True) or ""):
+            unique[sys_id] = record
+    return list(unique.values())
+
+
+def _servicenow_value(record, field, raw=False):
+    """
+    Returns a field of a record fetched with sysparm_display_value=all: the display
+    value (e.g. the location name of a reference), or the raw value if `raw` is set.
+    """
+    value = record.get(field)
+    if isinstance(value, dict):
+        value = value.get("value" if raw else "display_value")
+    return None if value == "" and raw else value
+
+
+def _parse_servicenow_date(value):
+    """Parses a ServiceNow date or date time value into a datetime, as the xlsx export holds."""
+    for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except (TypeError, ValueError):
             continue
-        # boolean used to check if interfaces were found
-        interface_bool = False
-        # list of interface ids
-        interface_ids = {}
-        # go through each interface and see if there is a match with the circuit id
-        for row2 in interfaces_ws.iter_rows(min_col=5,max_col=5):
-            for cell2 in row2:
-                # ignore blank descriptions
-                interface_desc = interfaces_ws.cell(row=cell2.row, column=5).value
-                if interface_desc is None:
-                    continue
-                # see if the site name matches
-                interface_site = interfaces_ws.cell(row=cell2.row, column=7).value
-                # Remove white space in circuit id
-                circuit_id = circuit_id.replace(" ", "")
-                # check if circuit id is found
-                if interface_desc.find(f"ref={circuit_id}") > -1:
-                    interface_bool = True
-                    if connect_type != "Internet":
-                        if source_site_name.find(interface_site) > -1:
-                            # define key variables
-                            device_id = interfaces_ws.cell(row=cell2.row, column=2).value
-                            interface_ids["aside_device"] = device_id
-                            interface_id = interfaces_ws.cell(row=cell2.row, column=3).value
-                            interface_ids["aside_interface"] = interface_id
-                        else:
-                            device_id = interfaces_ws.cell(row=cell2.row, column=2).value
-                            interface_ids["bside_device"] = device_id
-                            interface_id = interfaces_ws.cell(row=cell2.row, column=3).value
-                            interface_ids["bside_interface"] = interface_id
-                    else:
-                        device_id = interfaces_ws.cell(row=cell2.row, column=2).value
-                        interface_ids["internet_device"] = device_id
-                        interface_id = interfaces_ws.cell(row=cell2.row, column=3).value
-                        interface_ids["internet_interface"] = interface_id
-
-        # was an interface found then add
-        if interface_bool:
-            # match cell headers to values
-            c_connect_type = output_ws.cell(row = c_number, column = 1)
-            c_provider = output_ws.cell(row = c_number, column = 2)
-            c_cost_group_name = output_ws.cell(row = c_number, column = 3)
-            c_cost_formula = output_ws.cell(row = c_number, column = 4)
-            c_end_date = output_ws.cell(row = c_number, column = 5)
-            c_bandwidth = output_ws.cell(row = c_number, column = 6)
-            c_charge = output_ws.cell(row = c_number, column = 8)
-            c_currency = output_ws.cell(row = c_number, column = 12)
-            c_interface_id = output_ws.cell(row = c_number, column = 16)
-            c_contract_id = output_ws.cell(row = c_number, column = 13)
-            c_circuit_id = output_ws.cell(row = c_number, column = 14)
-            c_billing_start_date = output_ws.cell(row = c_number, column = 15)
-            c_device_id = output_ws.cell(row = c_number, column = 17)
-            c_price_per_mb = output_ws.cell(row = c_number, column = 11)
-            c_connect_type.value = circuit_type
-            c_provider.value = provider_name
-            c_cost_group_name.value = cost_group_name
-            c_cost_formula.value = "Commit (Blended)"
-            c_end_date.value = contract_end.strftime("%Y-%m-%d")
-            c_bandwidth.value = bandwidth
-            c_price_per_mb.value = price_per
-            c_charge.value = monthly_charge
-            c_currency.value = currency
-            c_contract_id.value = circuit_ws.cell(row=cell.row, column=8).value
-            c_billing_start_date.value = start_date.day
-            c_circuit_id.value = circuit_id
-            c_notes.value = "Circuit Added"
-            c_number = c_number + 1
-            if connect_type == "Internet":
-                c_device_id.value = interface_ids["internet_device"]
-                c_interface_id.value = interface_ids["internet_interface"]
-            elif "aside_interface" in interface_ids:
-                c_device_id.value = interface_ids["aside_device"]
-                c_interface_id.value = interface_ids["aside_interface"]
+    return None
+
+
+def servicenow_rows(records):
+    """Yields the circuit records as circuit sheet rows, in SERVICENOW_FIELDS column order."""
+    for record in records:
+        values = []
+        for field in SERVICENOW_FIELDS:
+            if field is None:
+                values.append(None)
+            elif field in SERVICENOW_DATE_FIELDS:
+                values.append(_parse_servicenow_date(_servicenow_value(record, field, raw=True)))
             else:
-                c_device_id.value = interface_ids["bside_device"]
-                c_interface_id.value = interface_ids["bside_interface"]
-        else:
-            c_notes.value = "interface was not found"
+                value = _servicenow_value(record, field)
+                # blank display values are blank cells in the export
+                values.append(None if value == "" else value)
+        yield values
+
+
+def load_watermark(path=WATERMARK_FILE_PATH):
+    """Returns the sys_updated_on of the newest circuit fetched by the last run, or None."""
+    try:
+        with open(path) as watermark_file:
+            return json.load(watermark_file).get("sys_updated_on")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_watermark(path, watermark):
+    with open(path, 'w') as watermark_file:
+        json.dump({"sys_updated_on": watermark}, watermark_file)
+
+
+def load_interface_refs():
+    """Reads the interfaces workbook row by row and indexes it by circuit reference."""
+    interfaces_workbook = openpyxl.load_workbook(INTERFACES_FILE_PATH, read_only=True)
+    try:
+        return build_interface_refs(interfaces_workbook.active.iter_rows(values_only=True))
+    finally:
+        interfaces_workbook.close()
+
+
+def run_in_place(interface_refs, evaluate=circuit_results):
+    """Fills in the output template and writes the notes back into circuits.xlsx."""
+    # open the circuit information workbook
+    circuit_workbook = openpyxl.load_workbook(CIRCUITS_FILE_PATH)
+    # open the circuit worksheet
+    circuit_ws = circuit_workbook.active
+    # open the output information workbook
+    output_workbook = openpyxl.load_workbook(OUTPUT_TEMPLATE_PATH)
+    # open the output worksheet
+    output_ws = output_workbook.active
+    # set the new row integer
+    c_number = 2
+    rows = circuit_ws.iter_rows(min_row=2, max_col=CIRCUIT_COLUMNS, values_only=True)
+    for row_number, (values, notes, output) in enumerate(evaluate(rows, interface_refs), start=2):
+        circuit_ws.cell(row=row_number, column=15).value = notes
+        if output is None:
             continue
-output_workbook.save('./connectivit_costs_bulk_import_saved.xlsx')
-circuit_workbook.save('./circuits.xlsx')
+        for column, value in enumerate(output, start=1):
+            if value is not None:
+                output_ws.cell(row=c_number, column=column).value = value
+        c_number = c_number + 1
+    output_workbook.save(OUTPUT_FILE_PATH)
+    circuit_workbook.save(CIRCUITS_FILE_PATH)
+
+
+def write_results(rows, interface_refs, results_path=RESULTS_FILE_PATH, evaluate=circuit_results):
+    """
+    Checks and matches a stream of circuit rows, appends the output to a write only
+    workbook and writes the notes to a separate results file.
+    """
+    # copy the header row of the output template
+    template_workbook = openpyxl.load_workbook(OUTPUT_TEMPLATE_PATH, read_only=True)
+    template_ws = template_workbook.active
+    output_title = template_ws.title
+    output_headers = next(template_ws.iter_rows(max_row=1, values_only=True), ())
+    template_workbook.close()
+
+    output_workbook = openpyxl.Workbook(write_only=True)
+    output_ws = output_workbook.create_sheet(title=output_title)
+    output_ws.append(output_headers)
+
+    with open(results_path, 'w', newline='') as results_file:
+        results = csv.writer(results_file)
+        results.writerow(RESULTS_HEADERS)
+        for row_number, (values, notes, output) in enumerate(evaluate(rows, interface_refs), start=2):
+            results.writerow([row_number, values[7], notes])
+            if output is not None:
+                output_ws.append(output)
+    output_workbook.save(OUTPUT_FILE_PATH)
+
+
+def run_streaming(interface_refs, results_path=RESULTS_FILE_PATH, evaluate=circuit_results):
+    """Streams the circuits workbook through write_results. circuits.xlsx is left untouched."""
+    circuit_workbook = openpyxl.load_workbook(CIRCUITS_FILE_PATH, read_only=True)
+    try:
+        rows = circuit_workbook.active.iter_rows(min_row=2, values_only=True)
+        write_results(rows, interface_refs, results_path, evaluate)
+    finally:
+        circuit_workbook.close()
+
+
+def run_servicenow(interface_refs, results_path=RESULTS_FILE_PATH, evaluate=circuit_results,
+                   full=False, watermark_path=WATERMARK_FILE_PATH):
+    """
+    Fetches the circuits changed since the last run from ServiceNow and streams them
+    through write_results. Returns (new watermark or None, whether only the changed
+    circuits were fetched). The caller saves the watermark once everything that
+    depends on the circuits, e.g. the --push, has succeeded.
+    """
+    since = None if full else load_watermark(watermark_path)
+    client = servicenow_client()
+    try:
+        records = fetch_servicenow_circuits(client, since=since)
+    finally:
+        client.close()
+    print(f"Fetched {len(records)} circuits from ServiceNow" + (f" updated at or after {since}" if since else "") + ".")
+    write_results(servicenow_rows(records), interface_refs, results_path, evaluate)
+    watermark = max((_servicenow_value(record, "sys_updated_on", raw=True) or "" for record in records), default="")
+    return (max(watermark, since or "") if watermark else None), since is not None
+
+
+def kentik_interface_rows(client, workers=INTERFACE_WORKERS, refresh=False, page_size=INTERFACE_PAGE_SIZE, ttl=DEFAULT_TTL):
+    """
+    Yields interface rows shaped like the interfaces.xlsx rows (device id column 2,
+    interface id column 3, description column 5, site column 7) for the Kentik
+    interfaces whose description or alias holds a ref= circuit reference.
+    Interfaces come from the local inventory cache, each device's interfaces are
+    fetched from interface/v202108alpha1/interfaces once their TTL has expired,
+    `workers` devices at a time.
+    """
+    resources = None
+    if page_size:
+        resources = {"interfaces": dict(RESOURCES["interfaces"], page_size=page_size)}
+    inventory = InventoryCache(client, ttl=ttl, resources=resources)
+
+    def device_rows(device):
+        site = (device.get("site") or {}).get("siteName")
+        rows = []
+        for interface in inventory.interfaces(device["id"], refresh=refresh):
+            description = " ".join(
+                str(interface[field]) for field in ("interfaceDescription", "snmpAlias") if interface.get(field)
+            )
+            if "ref=" not in description:
+                continue
+            rows.append((None, interface.get("deviceId", device["id"]), interface.get("id"), None, description, None, site))
+        return rows
+
+    try:
+        devices = inventory.list("devices", refresh=refresh)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for rows in executor.map(device_rows, devices):
+                yield from rows
+    finally:
+        inventory.close()
+
+
+def load_kentik_interface_refs(client, workers=INTERFACE_WORKERS, refresh=False, page_size=INTERFACE_PAGE_SIZE):
+    """Indexes the live Kentik interfaces by circuit reference."""
+    interface_refs = build_interface_refs(kentik_interface_rows(client, workers, refresh, page_size))
+    print(f"Indexed {sum(len(interfaces) for interfaces in interface_refs.values())} Kentik interfaces with circuit references.")
+    return interface_refs
+
+
+def main(stream=False, results_path=RESULTS_FILE_PATH, columnar=False, push=False, plan=False,
+         kentik_url=KENTIK_API_BASE_URL, workers=PUSH_WORKERS, servicenow=False, full=False,
+         watermark_path=WATERMARK_FILE_PATH, kentik_interfaces=False, refresh=False,
+         interface_workers=INTERFACE_WORKERS, interface_page_size=INTERFACE_PAGE_SIZE):
+    kentik_client = None
+    if push or kentik_interfaces:
+        kentik_client = KentikClient(KENTIK_API_EMAIL, KENTIK_API_TOKEN, base_url=kentik_url,
+                                     pool_maxsize=max(workers, interface_workers))
+    try:
+        if kentik_interfaces:
+            interface_refs = load_kentik_interface_refs(kentik_client, interface_workers, refresh, interface_page_size)
+        else:
+            interface_refs = load_interface_refs()
+        evaluate = columnar_circuit_results if columnar else circuit_results
+        # keep the matched output rows for --push
+        outputs = []
+
+        def evaluate_and_collect(rows, refs):
+            for values, notes, output in evaluate(rows, refs):
+                if output is not None:
+                    outputs.append(output)
+                yield values, notes, output
+
+        watermark = None
+        delta = False
+        if servicenow:
+            watermark, delta = run_servicenow(interface_refs, results_path, evaluate_and_collect, full=full, watermark_path=watermark_path)
+        elif stream:
+            run_streaming(interface_refs, results_path, evaluate_and_collect)
+        else:
+            run_in_place(interface_refs, evaluate_and_collect)
+        if push:
+            # a delta run only sees the changed circuits, so it can't tell which interfaces left a group
+            pushed = push_cost_groups(outputs, kentik_client, plan=plan, workers=workers, add_only=delta)
+            if plan or not pushed:
+                # keep the watermark so the next run sends these circuits (again)
+                watermark = None
+        if watermark:
+            save_watermark(watermark_path, watermark)
+    finally:
+        if kentik_client is not None:
+            kentik_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true", help="Read the workbooks row by row and write the notes to a separate results file instead of circuits.xlsx.")
+    parser.add_argument("--results", default=RESULTS_FILE_PATH, help="Path of the per-circuit notes file written in --stream mode (CSV).")
+    parser.add_argument("--columnar", action="store_true", help="Check all circuits at once with vectorized rules and print the number of rows each rule rejected.")
+    parser.add_argument("--push", action="store_true", help="Also send the matched circuits to the Kentik connectivity cost API, skipping unchanged cost groups.")
+    parser.add_argument("--plan", action="store_true", help="With --push, only print the cost group changes that would be sent.")
+    parser.add_argument("--kentik-url", default=KENTIK_API_BASE_URL, help="Kentik API base URL used by --push and --kentik-interfaces.")
+    parser.add_argument("--workers", type=int, default=PUSH_WORKERS, help="Number of cost group requests sent concurrently by --push.")
+    parser.add_argument("--servicenow", action="store_true", help="Fetch the circuits from the ServiceNow Table API instead of circuits.xlsx (notes go to the results file).")
+    parser.add_argument("--full", action="store_true", help="With --servicenow, fetch every circuit instead of only the ones updated since the last run.")
+    parser.add_argument("--watermark", default=WATERMARK_FILE_PATH, help="File holding the ServiceNow sys_updated_on watermark.")
+    parser.add_argument("--kentik-interfaces", action="store_true", help="Match against the live Kentik interfaces (cached locally) instead of interfaces.xlsx.")
+    parser.add_argument("--refresh", action="store_true", help="With --kentik-interfaces, re-download the devices and interfaces instead of using the local cache.")
+    parser.add_argument("--interface-workers", type=int, default=INTERFACE_WORKERS, help="Number of devices whose interfaces are fetched concurrently.")
+    parser.add_argument("--interface-page-size", type=int, default=INTERFACE_PAGE_SIZE, help="Fetch each device's interfaces in pages of this size (0 for a single request).")
+    args = parser.parse_args()
+    main(stream=args.stream, results_path=args.results, columnar=args.columnar, push=args.push, plan=args.plan,
+         kentik_url=args.kentik_url, workers=args.workers, servicenow=args.servicenow, full=args.full,
+         watermark_path=args.watermark, kentik_interfaces=args.kentik_interfaces, refresh=args.refresh,
+         interface_workers=args.interface_workers, interface_page_size=args.interface_page_size)
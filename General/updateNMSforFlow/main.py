@@ -2,12 +2,17 @@
 
 This script:
 - lists NMS devices from the Kentik API
-- updates each device to enable flow and snmp enrichment
+- updates each device whose current settings differ from the enrichment payload
 
 Usage:
   export KENTIK_API_BASE="https://api.kentik.com/api/v5"   # optional, defaults to above
   export KENTIK_API_TOKEN="..."                           # preferred: Bearer token
-  python main.py [--dry-run]
+  python main.py [--dry-run] [--plan] [--force] [--refresh]
+
+  --plan prints the field-by-field diff of each device that would be updated.
+  --force updates every device, even those that already match. The SNMP community is
+  not returned by the API, so use it to push a changed KENTIK_SNMP_COMMUNITY.
+  --refresh re-downloads the device list instead of using the local inventory cache.
 
 Notes:
 - The exact json keys used to enable enrichment may differ by Kentik API version.
@@ -16,10 +21,15 @@ Notes:
 """
 import os
 import sys
-import time
 import argparse
 import requests
 
+# Make the shared kentik_common package at the repository root importable.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from kentik_common.client import ApiClient
+from kentik_common.inventory_cache import InventoryCache
+from kentik_common.reconcile import MISSING, diff_fields, format_changes
+
 API_BASE = os.environ.get("KENTIK_API_BASE", "https://api.kentik.com/api/v5")
 API_TOKEN = os.environ.get("KENTIK_API_TOKEN")  # preferred: Bearer token
 REQUESTS_TIMEOUT = 30.0
@@ -40,11 +50,55 @@ def auth_headers():
         return {"X-CH-Auth-User": user, "X-CH-Auth-Key": key, "Content-Type": "application/json"}
     raise SystemExit("No auth found. Set KENTIK_API_TOKEN or KENTIK_USER+KENTIK_KEY environment variables.")
 
-def list_nms_devices():
-    url = f"{API_BASE}/nms/devices"
-    resp = requests.get(url, headers=auth_headers(), timeout=REQUESTS_TIMEOUT)
-    resp.raise_for_status()
-    return resp.json()
+_client = None
+
+def get_client():
+    """Return the pooled API client, created on first use so auth is only checked when needed."""
+    global _client
+    if _client is None:
+        # rate_limiter=True paces updates from the API's rate limit headers.
+        _client = ApiClient(API_BASE, headers=auth_headers(), timeout=REQUESTS_TIMEOUT, rate_limiter=True)
+    return _client
+
+_inventory = None
+
+def get_inventory():
+    """Return the local NMS device cache, so devices aren't downloaded on every run."""
+    global _inventory
+    if _inventory is None:
+        _inventory = InventoryCache(get_client(), resources={
+            "nms_devices": {"endpoint": "nms/devices", "key": "devices", "name": "name"},
+        })
+    return _inventory
+
+def list_nms_devices(refresh=False):
+    return {"devices": get_inventory().list("nms_devices", refresh)}
+
+# Payload fields that NMS device records may report under another key.
+NMS_DEVICE_ALIASES = {
+    "sendingIps": lambda d: d.get("sendingIpsList", d.get("sending_ips", MISSING)),
+    "siteId": lambda d: d.get("site_id", MISSING),
+    "planId": lambda d: d.get("plan_id", MISSING),
+    "deviceSubtype": lambda d: d.get("device_subtype", MISSING),
+    "deviceSampleRate": lambda d: d.get("device_sample_rate", MISSING),
+    "deviceBgpType": lambda d: d.get("device_bgp_type", MISSING),
+    "minimize_snmp": lambda d: d.get("minimizeSnmp", MISSING),
+    "deviceSnmpIp": lambda d: d.get("device_snmp_ip", MISSING),
+    "deviceSnmpCommunity": lambda d: d.get("device_snmp_community", MISSING),
+}
+
+# Payload fields set to fixed values or to DEFAULT_PLAN_ID.
+# A device that does not report one of them still needs it, so it is updated.
+# deviceSnmpCommunity is not listed: the API does not return the community string,
+# so it is only compared when a record reports it (use --force to push it).
+NMS_REQUIRED_FIELDS = (
+    "deviceSubtype", "deviceSampleRate", "deviceBgpType", "planId",
+    "minimize_snmp", "deviceSnmpIp",
+)
+
+def plan_device_update(device, payload):
+    """Return the fields of the payload that differ from the fetched device record."""
+    return diff_fields(payload["device"], device, aliases=NMS_DEVICE_ALIASES, missing=NMS_REQUIRED_FIELDS)
 
 def build_enrichment_payload(device):
     """
@@ -52,7 +106,7 @@ def build_enrichment_payload(device):
     Uses DEFAULT_PLAN_ID and DEFAULT_SNMP_COMMUNITY when device does not contain those fields.
     """
     device_name = device.get("deviceName") or device.get("name") or device.get("hostname") or device.get("device_name") or device.get("id")
-    sending_ips = device.get("sendingIps") or device.get("sendingIpsList") or device.get("deviceSnmpIp") or device.get("ip_address") or None
+    sending_ips = device.get("sendingIps") or device.get("sendingIpsList") or device.get("sending_ips") or device.get("deviceSnmpIp") or device.get("device_snmp_ip") or device.get("ip_address") or None
     site_id = device.get("siteId") or device.get("site_id") or None
 
     return {
@@ -63,24 +117,23 @@ def build_enrichment_payload(device):
             "deviceSampleRate": 1,
             "deviceDescription": f"Device created by Kentik automation script: {device_name}",
             "deviceBgpType": "none",
-            "planId": device.get("planId", DEFAULT_PLAN_ID),
+            "planId": device.get("planId", device.get("plan_id", DEFAULT_PLAN_ID)),
             "minimize_snmp": False,
             "siteId": site_id,
-            "deviceSnmpIp": device.get("deviceSnmpIp", sending_ips),
-            "deviceSnmpCommunity": device.get("deviceSnmpCommunity", DEFAULT_SNMP_COMMUNITY)
+            "deviceSnmpIp": device.get("deviceSnmpIp", device.get("device_snmp_ip", sending_ips)),
+            "deviceSnmpCommunity": device.get("deviceSnmpCommunity", device.get("device_snmp_community", DEFAULT_SNMP_COMMUNITY))
         }
     }
 
 def update_device(device_id, payload):
-    url = f"{API_BASE}/nms/devices/{device_id}"
     # use PATCH if supported by your API; PUT can be used if required (and you must supply full object)
-    resp = requests.patch(url, json=payload, headers=auth_headers(), timeout=REQUESTS_TIMEOUT)
+    resp = get_client().patch(f"nms/devices/{device_id}", json=payload)
     resp.raise_for_status()
     return resp.json()
 
-def main(dry_run=False, pause_between=0.1):
+def main(dry_run=False, plan=False, force=False, refresh=False):
     print("Listing NMS devices...")
-    data = list_nms_devices()
+    data = list_nms_devices(refresh)
     # Response shape may wrap devices under a key like "devices" or be a plain list.
     devices = data.get("devices") if isinstance(data, dict) and "devices" in data else data
     if not devices:
@@ -89,6 +142,7 @@ def main(dry_run=False, pause_between=0.1):
 
     print(f"Found {len(devices)} devices. Preparing to enable enrichment on each device.")
     failures = []
+    unchanged = 0
     for d in devices:
         # device id field may be 'id' or 'device_id' depending on API version
         device_id = d.get("id") or d.get("device_id")
@@ -98,16 +152,24 @@ def main(dry_run=False, pause_between=0.1):
             continue
 
         payload = build_enrichment_payload(d)
+        changes = plan_device_update(d, payload)
+        if not changes and not force:
+            unchanged += 1
+            continue
+        if plan:
+            print(f"PLAN: device {name} ({device_id})\n{format_changes(changes)}")
+            continue
         print(f"{'DRY-RUN:' if dry_run else 'UPDATING:'} device {name} ({device_id}) -> {payload}")
         if dry_run:
             continue
         try:
             update_device(device_id, payload)
+            get_inventory().upsert("nms_devices", {**d, **payload["device"]})
         except Exception as e:
             print(f"ERROR updating {device_id}: {e}")
             failures.append((device_id, str(e)))
-        time.sleep(pause_between)
 
+    print(f"{unchanged} devices already match and were skipped.")
     if failures:
         print(f"Completed with {len(failures)} failures. See details:")
         for fid, reason in failures:
@@ -118,9 +180,12 @@ def main(dry_run=False, pause_between=0.1):
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument("--dry-run", action="store_true", help="Only show changes, do not call API to update.")
+    p.add_argument("--plan", action="store_true", help="Only show the field diff of devices that would change, do not call API to update.")
+    p.add_argument("--force", action="store_true", help="Update every device, even when it already matches the payload.")
+    p.add_argument("--refresh", action="store_true", help="Re-download the NMS device list instead of using the local cache.")
     args = p.parse_args()
     try:
-        main(dry_run=args.dry_run)
+        main(dry_run=args.dry_run, plan=args.plan, force=args.force, refresh=args.refresh)
     except requests.HTTPError as he:
         print(f"HTTP error: {he} - response content: {getattr(he.response, 'text', '')}")
         sys.exit(2)
@@ -1,42 +1,37 @@
 
 import modules.auth as auth
-import requests
 import yaml
 from pprint import pprint
 import json
+import os
 import sys
 
+# Make the shared kentik_common package at the repository root importable.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from kentik_common.client import KentikClient
+from kentik_common.inventory_cache import InventoryCache
+
+# Pooled, keep-alive client shared by every request this script makes.
+KENTIK_CLIENT = KentikClient(auth.username, auth.apikey)
+# Local mirror of the synthetic tests so the test list isn't downloaded on every run.
+INVENTORY = InventoryCache(KENTIK_CLIENT)
+
 def gather_parameters():
     print("Gathering user parameters...")
 
 
 def collect_current_test(test_name):
     print(f"Connecting to the Kentik API, looking for {test_name}...")
-    url = "https://grpc.api.kentik.com/synthetics/v202309/tests"
-    payload = {}
-    headers = {
-        'X-CH-Auth-Email': auth.username,
-        'X-CH-Auth-API-Token': auth.apikey
-    }
-
-    response = requests.request("GET", url, headers=headers, data=payload)
-    test_data = response.json()
-
-
-    for test in test_data['tests']:
-        if test['name'] == test_name:
-            return test['id']
+    for refresh in (False, True):
+        # The test may have been created since the cache was refreshed.
+        for test in INVENTORY.find("synthetic_tests", test_name, refresh=refresh):
+            if test['name'] == test_name:
+                return test['id']
 
     raise ValueError(f"Test Name, {test_name}, Not Found")
 
 def gather_current_test_config(test_id):
-    url = f"https://grpc.api.kentik.com/synthetics/v202309/tests/{test_id}"
-    payload = {}
-    headers = {
-        'X-CH-Auth-Email': auth.username,
-        'X-CH-Auth-API-Token': auth.apikey
-    }
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = KENTIK_CLIENT.get(f"synthetics/v202309/tests/{test_id}")
 
     test_data = response.json()
 
@@ -48,15 +43,11 @@ def gather_current_test_config(test_id):
 
 def update_dns_grid(test_id,ip_list,test_data):
     test_data["test"]["settings"]["dnsGrid"]["servers"] = ip_list
-    url = f"https://grpc.api.kentik.com/synthetics/v202309/tests/{test_id}"
-    headers = {
-        'X-CH-Auth-Email': auth.username,
-        'X-CH-Auth-API-Token': auth.apikey
-    }
-
     payload = json.dumps(test_data)
 
-    response = requests.request("PUT", url, headers=headers, data=payload)
+    response = KENTIK_CLIENT.put(f"synthetics/v202309/tests/{test_id}", data=payload)
+    if response.status_code == 200:
+        INVENTORY.upsert("synthetic_tests", response.json().get("test") or test_data["test"])
 
     print(response.status_code)
 
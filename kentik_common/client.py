@@ -0,0 +1,164 @@
+"""Shared HTTP client for the Kentik (and NetBox) automation scripts.
+
+Every script in this repository used to open a brand new TCP+TLS connection for
+each API call. This module wraps a single requests.Session per client so that
+connections are kept alive and reused, with:
+
+- a connection pool per host (sized via `pool_sizes`)
+- default connect/read timeouts
+- one retry policy shared by every script (see DEFAULT_RETRIES)
+- optional adaptive rate limiting (see kentik_common.rate_limit). Kentik clients
+  share one limiter per API host, so every thread or task in a process stays
+  within the budget advertised by the API.
+
+Usage:
+  from kentik_common.client import KentikClient
+  client = KentikClient(email, token)
+  response = client.get("device/v202308beta1/device")
+"""
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from kentik_common.rate_limit import reset_delay, shared_limiter
+
+KENTIK_API_BASE_URL = "https://grpc.api.kentik.com"
+KENTIK_API_BASE_URL_EU = "https://grpc.api.kentik.eu"
+
+# (connect timeout, read timeout) in seconds
+DEFAULT_TIMEOUT = (5, 30)
+
+# Number of hosts to keep pools for and number of kept-alive connections per host.
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+# Retry policy: 5 attempts with exponential backoff (0.5s, 1s, 2s, ...).
+# Connection errors and 5xx responses to idempotent methods are retried by urllib3.
+# 429 responses are retried by ApiClient.request for every method, after waiting
+# for the rate limit window to reset, since the server applied nothing.
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+def build_retry(retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR):
+    """Builds the shared retry policy."""
+    return Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        respect_retry_after_header=True,
+        # Hand the last response back to the caller instead of raising, the
+        # scripts decide for themselves how to report errors.
+        raise_on_status=False,
+    )
+
+
+class ApiClient:
+    """
+    Pooled, keep-alive HTTP client bound to a base URL and a set of headers.
+    Relative paths are joined to `base_url`, absolute URLs are used as is.
+
+    `rate_limiter` is either None (no limiting), a RateLimiter used for every
+    request, or True to use the process-wide shared limiter of each request's host.
+    """
+
+    def __init__(self, base_url="", headers=None, timeout=DEFAULT_TIMEOUT,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_sizes=None, retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                 rate_limiter=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.rate_limiter = rate_limiter
+        self.session = requests.Session()
+        if headers:
+            self.session.headers.update(headers)
+        retry = build_retry(retries, backoff_factor)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Per-host pool sizing, e.g. {"grpc.api.kentik.com": 20}
+        for host, size in (pool_sizes or {}).items():
+            host_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, max_retries=retry)
+            self.session.mount(f"https://{host}/", host_adapter)
+            self.session.mount(f"http://{host}/", host_adapter)
+
+    def url(self, path):
+        """Returns the full URL for a path relative to the base URL."""
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def limiter_for(self, url):
+        """Returns the rate limiter that applies to a URL, or None."""
+        if self.rate_limiter is True:
+            return shared_limiter(urlsplit(url).netloc)
+        return self.rate_limiter
+
+    def request(self, method, path, **kwargs):
+        """Sends a request and returns the requests.Response."""
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.url(path)
+        limiter = self.limiter_for(url)
+        for attempt in range(self.retries + 1):
+            if limiter:
+                limiter.acquire()
+            response = self.session.request(method.upper(), url, **kwargs)
+            if limiter:
+                limiter.update(response.headers, response.status_code)
+            if response.status_code != 429 or attempt == self.retries:
+                break
+            if not limiter:
+                # Without a limiter to pause every caller, wait here for the window to reset.
+                time.sleep(reset_delay(response.headers) or self.backoff_factor * 2 ** attempt)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class KentikClient(ApiClient):
+    """
+    ApiClient preconfigured with the Kentik API authentication headers.
+    Requests are rate limited by the shared per-host limiter unless another
+    `rate_limiter` is given.
+    """
+
+    def __init__(self, email, token, base_url=KENTIK_API_BASE_URL, **kwargs):
+        kwargs.setdefault("rate_limiter", True)
+        headers = {
+            "X-CH-Auth-Email": email,
+            "X-CH-Auth-API-Token": token,
+            "Content-Type": "application/json",
+        }
+        headers.update(kwargs.pop("headers", None) or {})
+        super().__init__(base_url, headers=headers, **kwargs)
@@ -0,0 +1,287 @@
+"""Local SQLite mirror of the Kentik inventory shared by the scripts.
+
+Instead of downloading the full device, site, label, interface and synthetic
+test lists on every run, the scripts read them from an on-disk cache:
+
+- every kind of record is stored in its own table, indexed by id, by lowercase
+  name and by parent (the device id for interfaces)
+- a kind is only fetched from the API again once its TTL has expired
+- refreshes are applied incrementally: records whose edate did not change are
+  left alone and only new, changed and deleted records are written
+- for APIs that can filter on edate (a resource with a "since" parameter) only
+  the records changed since the newest stored edate are fetched, with a full
+  refresh every FULL_REFRESH_TTL to pick up deletions. The Kentik list APIs used
+  below have no such filter, so they fall back to a TTL based full refresh.
+- scripts write their own creates/updates through with `upsert`, so the cache
+  stays current between refreshes
+
+The cache file defaults to ~/.cache/kentik_automation/inventory-<account>.sqlite3,
+one file per API base URL and user. Set KENTIK_INVENTORY_CACHE to override the
+path and KENTIK_INVENTORY_TTL to change the TTL (seconds).
+
+Usage:
+  cache = InventoryCache(client)
+  devices = cache.list("devices")
+  cache.find("synthetic_tests", "my dns test")
+  cache.interfaces(device_id)
+  cache.interfaces_by_device(device_ids)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_TTL = int(os.environ.get("KENTIK_INVENTORY_TTL", 900))
+FULL_REFRESH_TTL = 24 * 3600
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "kentik_automation")
+# Number of devices whose interfaces are listed per request by interfaces_by_device.
+DEVICE_BATCH_SIZE = 50
+
+# Headers identifying the account a client is authenticated as. Every one of them
+# is part of the cache key, so accounts never share a cache file.
+ACCOUNT_HEADERS = ("X-CH-Auth-Email", "X-CH-Auth-User", "Authorization")
+
+# kind -> how to list it from the API
+#   endpoint: path relative to the client's base URL
+#   params: query parameters
+#   key: key of the list in the response (the response may also be a plain list)
+#   name: field stored in the indexed name column
+#   parent: field stored in the indexed parent_id column
+#   since: query parameter that filters the listing to records changed after an edate
+#   page_size: if set, the listing is fetched in pages of this many records, using
+#     the limit_param and offset_param query parameters (default "limit" and "offset")
+RESOURCES = {
+    "devices": {"endpoint": "device/v202308beta1/device", "params": {"query.noCustomColumns": "true"},
+                "key": "devices", "name": "deviceName"},
+    "sites": {"endpoint": "site/v202211/sites", "key": "sites", "name": "title"},
+    "labels": {"endpoint": "label/v202210/labels", "key": "labels", "name": "name"},
+    "synthetic_tests": {"endpoint": "synthetics/v202309/tests", "key": "tests", "name": "name"},
+    "interfaces": {"endpoint": "interface/v202108alpha1/interfaces", "key": "interfaces",
+                   "name": "interfaceDescription", "parent": "deviceId"},
+}
+
+
+def default_cache_path(client):
+    """Returns the default cache file for the account the client is authenticated as."""
+    if os.environ.get("KENTIK_INVENTORY_CACHE"):
+        return os.environ["KENTIK_INVENTORY_CACHE"]
+    headers = client.session.headers
+    account = "|".join(str(headers.get(header) or "") for header in ACCOUNT_HEADERS)
+    digest = hashlib.sha1(f"{client.base_url}|{account}".encode()).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"inventory-{digest}.sqlite3")
+
+
+class InventoryCache:
+    """
+    SQLite backed inventory mirror. Safe to share between threads.
+    `resources` adds or overrides entries of RESOURCES, e.g. for other APIs.
+    """
+
+    def __init__(self, client, path=None, ttl=DEFAULT_TTL, resources=None):
+        self.client = client
+        self.ttl = ttl
+        self.resources = dict(RESOURCES, **(resources or {}))
+        self.path = path or default_cache_path(client)
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS refreshes "
+                "(scope TEXT PRIMARY KEY, refreshed_at REAL, full_refreshed_at REAL, watermark TEXT)"
+            )
+            for kind in self.resources:
+                self._db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {kind} "
+                    "(id TEXT PRIMARY KEY, parent_id TEXT, name TEXT, edate TEXT, data TEXT NOT NULL)"
+                )
+                self._db.execute(f"CREATE INDEX IF NOT EXISTS {kind}_name ON {kind} (name)")
+                self._db.execute(f"CREATE INDEX IF NOT EXISTS {kind}_parent ON {kind} (parent_id)")
+
+    # --- Reading ---
+
+    def list(self, kind, refresh=False):
+        """Returns every record of a kind, refreshing it first if stale."""
+        self.refresh(kind, force=refresh)
+        return self._select(kind, "")
+
+    def find(self, kind, name, refresh=False):
+        """Returns the records of a kind whose name matches, case-insensitively."""
+        self.refresh(kind, force=refresh)
+        return self._select(kind, "WHERE name = ?", (str(name).lower(),))
+
+    def get(self, kind, record_id, refresh=False):
+        """Returns one record by id, or None."""
+        self.refresh(kind, force=refresh)
+        records = self._select(kind, "WHERE id = ?", (str(record_id),))
+        return records[0] if records else None
+
+    def interfaces(self, device_id, refresh=False):
+        """Returns the interfaces of one device, refreshing them first if stale."""
+        device_id = str(device_id)
+        scope = f"interfaces:{device_id}"
+        if refresh or not self._is_fresh(scope):
+            records = self._fetch("interfaces", {"filters.deviceIds": device_id})
+            self._apply("interfaces", records, scope, "WHERE parent_id = ?", (device_id,), full=True)
+        return self._select("interfaces", "WHERE parent_id = ?", (device_id,))
+
+    def interfaces_by_device(self, device_ids, refresh=False, batch_size=DEVICE_BATCH_SIZE):
+        """
+        Returns {device id: interfaces} for many devices. The devices whose interfaces
+        are stale are listed `batch_size` devices per request, and the response is
+        partitioned by deviceId locally.
+        """
+        device_ids = list(dict.fromkeys(str(device_id) for device_id in device_ids))
+        stale = [device_id for device_id in device_ids if refresh or not self._is_fresh(f"interfaces:{device_id}")]
+        for start in range(0, len(stale), batch_size):
+            batch = stale[start:start + batch_size]
+            by_device = {device_id: [] for device_id in batch}
+            for record in self._fetch("interfaces", {"filters.deviceIds": batch}):
+                device_id = str(record.get("deviceId"))
+                if device_id in by_device:
+                    by_device[device_id].append(record)
+            for device_id, records in by_device.items():
+                self._apply("interfaces", records, f"interfaces:{device_id}", "WHERE parent_id = ?", (device_id,), full=True)
+        return {
+            device_id: self._select("interfaces", "WHERE parent_id = ?", (device_id,)) for device_id in device_ids
+        }
+
+    def _select(self, kind, where, args=()):
+        with self._lock:
+            rows = self._db.execute(f"SELECT data FROM {kind} {where}", args).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    # --- Refreshing ---
+
+    def refresh(self, kind, force=False):
+        """Re-fetches a kind from the API if its TTL has expired (or if force is set)."""
+        if not force and self._is_fresh(kind):
+            return
+        since = self.resources[kind].get("since")
+        state = self._state(kind)
+        if not force and since and state and state[2] and time.time() - state[1] < FULL_REFRESH_TTL:
+            self._apply(kind, self._fetch(kind, {since: state[2]}), kind, "", (), full=False)
+        else:
+            self._apply(kind, self._fetch(kind), kind, "", (), full=True)
+
+    def invalidate(self, scope=None):
+        """Marks a kind (or interface scope) as stale, or everything if scope is None."""
+        with self._lock, self._db:
+            if scope is None:
+                self._db.execute("DELETE FROM refreshes")
+            else:
+                self._db.execute("DELETE FROM refreshes WHERE scope = ?", (scope,))
+
+    def _state(self, scope):
+        """Returns (refreshed_at, full_refreshed_at, watermark) of a scope, or None."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT refreshed_at, full_refreshed_at, watermark FROM refreshes WHERE scope = ?", (scope,)
+            ).fetchone()
+
+    def _is_fresh(self, scope):
+        state = self._state(scope)
+        return state is not None and time.time() - state[0] < self.ttl
+
+    def _fetch(self, kind, params=None):
+        resource = self.resources[kind]
+        params = dict(resource.get("params") or {}, **(params or {}))
+        page_size = resource.get("page_size")
+        if not page_size:
+            return self._fetch_page(resource, params)
+        # page through the listing until a short page (or a page with nothing new,
+        # in case the API ignores the paging parameters)
+        records = []
+        seen = set()
+        offset = 0
+        while True:
+            page = self._fetch_page(resource, dict(params, **{
+                resource.get("limit_param", "limit"): page_size,
+                resource.get("offset_param", "offset"): offset,
+            }))
+            new = [record for record in page if self._record_id(record) not in seen]
+            records.extend(new)
+            seen.update(self._record_id(record) for record in new)
+            if len(page) < page_size or not new:
+                return records
+            offset += page_size
+
+    def _fetch_page(self, resource, params):
+        response = self.client.get(resource["endpoint"], params=params)
+        response.raise_for_status()
+        payload = response.json()
+        if isinstance(payload, list):
+            return payload
+        return payload.get(resource["key"]) or []
+
+    def _apply(self, kind, records, scope, where, args, full):
+        """
+        Writes a listing of `scope` to the cache. Records with an unchanged edate
+        are skipped, records without one are always rewritten. After a full
+        listing, records no longer listed are deleted.
+        """
+        with self._lock, self._db:
+            stored = dict(self._db.execute(f"SELECT id, edate FROM {kind} {where}", args).fetchall())
+            previous = self._db.execute(
+                "SELECT full_refreshed_at, watermark FROM refreshes WHERE scope = ?", (scope,)
+            ).fetchone()
+            full_refreshed_at, watermark = previous if previous and not full else (None, None)
+            seen = set()
+            for record in records:
+                record_id, edate = self._record_id(record), record.get("edate")
+                if record_id is None:
+                    continue
+                seen.add(record_id)
+                if edate:
+                    watermark = max(watermark or edate, edate)
+                if edate and stored.get(record_id) == edate:
+                    continue
+                self._write(kind, record)
+            now = time.time()
+            if full:
+                full_refreshed_at = now
+                for record_id in set(stored) - seen:
+                    self._db.execute(f"DELETE FROM {kind} WHERE id = ?", (record_id,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO refreshes (scope, refreshed_at, full_refreshed_at, watermark) VALUES (?, ?, ?, ?)",
+                (scope, now, full_refreshed_at, watermark),
+            )
+
+    # --- Writing ---
+
+    def upsert(self, kind, record):
+        """Writes a record created or updated by a script through to the cache."""
+        if self._record_id(record) is None:
+            return
+        with self._lock, self._db:
+            self._write(kind, record)
+
+    def delete(self, kind, record_id):
+        with self._lock, self._db:
+            self._db.execute(f"DELETE FROM {kind} WHERE id = ?", (str(record_id),))
+
+    def _write(self, kind, record):
+        resource = self.resources[kind]
+        name = record.get(resource.get("name", "name"))
+        parent = record.get(resource["parent"]) if resource.get("parent") else None
+        self._db.execute(
+            f"INSERT OR REPLACE INTO {kind} (id, parent_id, name, edate, data) VALUES (?, ?, ?, ?, ?)",
+            (
+                self._record_id(record),
+                None if parent is None else str(parent),
+                None if name is None else str(name).lower(),
+                record.get("edate"),
+                json.dumps(record),
+            ),
+        )
+
+    @staticmethod
+    def _record_id(record):
+        record_id = record.get("id", record.get("device_id"))
+        return None if record_id is None else str(record_id)
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,242 @@
+"""Batched, gzip-compressed writer for the Kentik kmetrics (influx line protocol) API.
+
+Lets the scripts push metrics to kmetrics/v202207/metrics directly instead of
+going through telegraf and its local JSON files:
+
+- metrics are encoded to influx line protocol (`encode_line`)
+- a background thread sends them in batches of up to `batch_size` lines or
+  `batch_bytes` bytes, or whatever has been written after `flush_interval` seconds
+- request bodies are gzip compressed
+- the in-memory buffer is bounded: once `max_buffer` lines are waiting, `write`
+  blocks until the sender catches up (backpressure)
+- failed batches are retried with exponential backoff and, once retries are
+  exhausted, spilled to `spill_dir` and re-sent after the next successful batch
+
+Usage:
+  client = KentikClient(email, token)
+  with KmetricsWriter(client, spill_dir="/var/spool/kmetrics") as writer:
+      writer.write("/interfaces/counters", {"device_name": "sfo-wan-002"}, {"in-octets": 1234})
+"""
+import glob
+import gzip
+import math
+import os
+import queue
+import threading
+import time
+
+import requests
+
+KMETRICS_PATH = "kmetrics/v202207/metrics"
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_BYTES = 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 10  # seconds
+DEFAULT_MAX_BUFFER = 100000  # lines
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5
+# Spilled batches re-sent after each successful batch.
+SPILL_REPLAY_BATCHES = 10
+
+
+def _escape(value, characters):
+    """Escapes the given characters in a measurement, key or tag value. Newlines aren't allowed in them."""
+    value = str(value).replace("\n", " ")
+    for character in characters:
+        value = value.replace(character, f"\\{character}")
+    return value
+
+
+def _field_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+def encode_line(measurement, tags=None, fields=None, timestamp=None):
+    """
+    Encodes one metric as an influx line protocol line (without the newline).
+    Tags and fields with a None or empty value are left out, and so are NaN and
+    infinite fields, which line protocol can't express. `timestamp` is in
+    nanoseconds; without one the server's receive time is used.
+    """
+    parts = [_escape(measurement, ", ")]
+    for key, value in (tags or {}).items():
+        if value is None or value == "":
+            continue
+        parts.append(f"{_escape(key, ',= ')}={_escape(value, ',= ')}")
+    field_set = ",".join(
+        f"{_escape(key, ',= ')}={_field_value(value)}" for key, value in (fields or {}).items()
+        if value is not None and not (isinstance(value, float) and not math.isfinite(value))
+    )
+    if not field_set:
+        raise ValueError(f"Metric {measurement} has no fields.")
+    line = f"{','.join(parts)} {field_set}"
+    if timestamp is not None:
+        line += f" {int(timestamp)}"
+    return line
+
+
+class KmetricsWriter:
+    """
+    Sends line protocol to the kmetrics API from a background thread.
+    `client` is a KentikClient (or any ApiClient carrying the Kentik auth headers).
+    """
+
+    def __init__(self, client, path=KMETRICS_PATH, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, max_buffer=DEFAULT_MAX_BUFFER, compress=True,
+                 retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR, spill_dir=None):
+        self.client = client
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.spill_dir = spill_dir
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.sent = 0
+        self.spilled = 0
+        self.dropped = 0
+        self._spill_count = 0
+        self._queue = queue.Queue(maxsize=max_buffer)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="kmetrics-writer", daemon=True)
+        self._thread.start()
+
+    # --- Writing ---
+
+    def write(self, measurement, tags=None, fields=None, timestamp=None, timeout=None):
+        """Queues one metric. Blocks while the buffer is full (raises queue.Full after `timeout`)."""
+        self.write_line(encode_line(measurement, tags, fields, timestamp), timeout=timeout)
+
+    def write_line(self, line, timeout=None):
+        """Queues one already encoded line protocol line."""
+        if self._closed.is_set():
+            raise RuntimeError("KmetricsWriter is closed.")
+        self._queue.put(line, timeout=timeout)
+
+    def flush(self):
+        """Blocks until every line written so far has been sent (or spilled)."""
+        self._queue.join()
+
+    def close(self):
+        """Sends what is left in the buffer and stops the background thread."""
+        if not self._closed.is_set():
+            self.flush()
+            self._closed.set()
+            self._queue.put(None)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # --- Sending ---
+
+    def _next_batch(self):
+        """Collects lines until the batch is full or flush_interval has passed since the first one."""
+        try:
+            line = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+        if line is None:
+            # Wake-up sent by close().
+            self._queue.task_done()
+            return []
+        batch = [line]
+        size = len(line) + 1
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and size < self.batch_bytes:
+            remaining = deadline - time.monotonic()
+            try:
+                line = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if line is None:
+                self._queue.task_done()
+                break
+            batch.append(line)
+            size += len(line) + 1
+        return batch
+
+    def _run(self):
+        while not (self._closed.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                if self._send("\n".join(batch) + "\n"):
+                    self._replay_spilled()
+                else:
+                    self._spill(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _send(self, body):
+        """
+        Sends one batch, retrying connection errors and 5xx responses with exponential
+        backoff (429s are waited out by the client). Returns True once the batch was
+        accepted. A batch rejected with another 4xx is dropped, since it would never
+        be accepted.
+        """
+        data = body.encode()
+        headers = {"Content-Type": "application/influx"}
+        if self.compress:
+            data = gzip.compress(data)
+            headers["Content-Encoding"] = "gzip"
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.client.post(self.path, data=data, headers=headers)
+                if response.status_code < 300:
+                    self.sent += body.count("\n")
+                    return True
+                print(f"kmetrics write failed: {response.status_code} {response.text}")
+                if 400 <= response.status_code < 500 and response.status_code != 429:
+                    self.dropped += body.count("\n")
+                    return True
+            except requests.exceptions.RequestException as e:
+                print(f"kmetrics write failed: {e}")
+            if attempt < self.retries:
+                time.sleep(self.backoff_factor * 2 ** attempt)
+        return False
+
+    # --- Spilling ---
+
+    def _spill(self, batch):
+        if not self.spill_dir:
+            print(f"kmetrics: dropping {len(batch)} lines, retries exhausted and no spill_dir set.")
+            self.dropped += len(batch)
+            return
+        self._spill_count += 1
+        path = os.path.join(self.spill_dir, f"kmetrics-{time.time_ns()}-{self._spill_count}.lp")
+        with open(f"{path}.tmp", "w") as spill_file:
+            spill_file.write("\n".join(batch) + "\n")
+        os.replace(f"{path}.tmp", path)
+        self.spilled += len(batch)
+        print(f"kmetrics: spilled {len(batch)} lines to {path}")
+
+    def spilled_files(self):
+        """Returns the spilled batch files, oldest first."""
+        if not self.spill_dir:
+            return []
+        return sorted(glob.glob(os.path.join(self.spill_dir, "kmetrics-*.lp")),
+                      key=lambda path: [int(part) for part in os.path.basename(path)[9:-3].split("-")])
+
+    def _replay_spilled(self):
+        """Re-sends up to SPILL_REPLAY_BATCHES spilled batches, stopping at the first failure."""
+        for path in self.spilled_files()[:SPILL_REPLAY_BATCHES]:
+            with open(path, "r") as spill_file:
+                body = spill_file.read()
+            if not self._send(body):
+                return
+            os.remove(path)
@@ -0,0 +1,142 @@
+"""Adaptive token-bucket rate limiter shared by threads and asyncio tasks.
+
+The limiter starts at DEFAULT_RATE requests per second and then learns the real
+budget from the rate limit headers returned by the API:
+
+- x-ratelimit-remaining: requests left in the current window
+- x-ratelimit-reset: seconds (or an epoch timestamp) until the window resets
+
+The remaining budget is spread evenly over the time left in the window, and a
+429 or an exhausted budget pauses every caller until the window resets.
+
+Usage:
+  limiter = shared_limiter("grpc.api.kentik.com")
+  limiter.acquire()              # threads
+  await limiter.acquire_async()  # asyncio tasks
+  limiter.update(response.headers, response.status_code)
+"""
+import asyncio
+import threading
+import time
+
+DEFAULT_RATE = 5.0  # requests per second until the API tells us otherwise
+MIN_RATE = 0.01
+MAX_RATE = 100.0
+# Pause used on a 429 that carries no reset information.
+DEFAULT_PAUSE = 60
+
+REMAINING_HEADER = "x-ratelimit-remaining"
+RESET_HEADER = "x-ratelimit-reset"
+RETRY_AFTER_HEADER = "retry-after"
+
+
+def _header_value(headers, name):
+    """Returns a header as a float, or None if missing or not numeric."""
+    value = headers.get(name)
+    if value is None:
+        value = {k.lower(): v for k, v in headers.items()}.get(name)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def reset_delay(headers):
+    """Returns the seconds until the rate limit window resets, or None if the headers don't say."""
+    reset = _header_value(headers, RESET_HEADER)
+    if reset is not None and reset > 1e9:
+        # Epoch timestamp rather than a number of seconds.
+        reset = max(0.0, reset - time.time())
+    if reset is None:
+        reset = _header_value(headers, RETRY_AFTER_HEADER)
+    return reset
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket. Callers reserve a token under the lock and sleep
+    outside of it, so the same instance can be shared by worker threads and
+    asyncio tasks.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        # Time the bucket was last refilled. Set into the future while paused.
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self, tokens=1):
+        """Takes tokens from the bucket and returns the seconds to wait before sending."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= tokens
+            wait = max(0.0, self.updated - now)
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+            return wait
+
+    def acquire(self, tokens=1):
+        """Blocks the calling thread until it may send a request."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        """Waits without blocking the event loop until the task may send a request."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Stops handing out tokens for the given number of seconds."""
+        with self._lock:
+            now = time.monotonic()
+            resume_at = now + seconds
+            if resume_at > self.updated:
+                self._refill(now)
+                self.updated = resume_at
+                self.tokens = min(self.tokens, 0.0)
+
+    def set_rate(self, rate):
+        """Changes the refill rate, clamped to [min_rate, max_rate]."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(max(rate, self.min_rate), self.max_rate)
+            self.capacity = max(1.0, self.rate)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def update(self, headers, status_code=None):
+        """Learns the current budget from a response's rate limit headers."""
+        remaining = _header_value(headers, REMAINING_HEADER)
+        reset = reset_delay(headers)
+        if status_code == 429:
+            self.pause(reset if reset is not None else DEFAULT_PAUSE)
+            return
+        if remaining is None:
+            return
+        if remaining <= 0:
+            self.pause(reset if reset is not None else DEFAULT_PAUSE)
+        elif reset:
+            self.set_rate(remaining / reset)
+
+
+_shared_limiters = {}
+_shared_lock = threading.Lock()
+
+
+def shared_limiter(name, rate=DEFAULT_RATE):
+    """Returns the process-wide limiter for `name` (usually an API host), creating it on first use."""
+    with _shared_lock:
+        if name not in _shared_limiters:
+            _shared_limiters[name] = RateLimiter(rate)
+        return _shared_limiters[name]
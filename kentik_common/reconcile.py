@@ -0,0 +1,82 @@
+"""Field-by-field comparison of desired payloads against fetched API records.
+
+Used by the scripts to skip writes that would not change anything, and to
+print a plan of the writes they would make.
+
+Usage:
+  changes = diff_fields(payload['device'], fetched_device, aliases=KENTIK_DEVICE_ALIASES)
+  if changes:
+      print(format_changes(changes))
+"""
+
+# Returned by field getters when a record does not report a field.
+MISSING = object()
+
+# Payload fields the v202308beta1 device API reports under another shape.
+KENTIK_DEVICE_ALIASES = {
+    "planId": lambda device: (device.get("plan") or {}).get("id", MISSING),
+    "siteId": lambda device: (device.get("site") or {}).get("id", MISSING),
+    "minimize_snmp": lambda device: device.get("minimizeSnmp", MISSING),
+}
+
+
+def normalize(value):
+    """
+    Normalizes a value for comparison: blanks become None, numbers and ids are
+    compared as strings and lists are compared as sorted sets.
+    """
+    if value is None or value == "" or value == [] or value == {}:
+        return None
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (list, tuple, set)):
+        items = [normalize(item) for item in value]
+        return sorted(str(item) for item in items if item is not None) or None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def current_value(record, field, aliases=None):
+    """Returns a field of a fetched record, or MISSING if the record does not report it."""
+    if field in record:
+        return record[field]
+    if aliases and field in aliases:
+        return aliases[field](record)
+    return MISSING
+
+
+def diff_fields(desired, current, aliases=None, ignore=(), missing=()):
+    """
+    Compares the desired payload against the current record field by field.
+    Returns {field: (current value, desired value)} for the fields that differ.
+    Fields the current record does not report can't be compared and are skipped,
+    except the ones in `missing`, which then count as changed (from None).
+    """
+    changes = {}
+    for field, desired_value in desired.items():
+        if field in ignore:
+            continue
+        value = current_value(current, field, aliases)
+        if value is MISSING:
+            if field in missing and normalize(desired_value) is not None:
+                changes[field] = (None, desired_value)
+            continue
+        # A single value in the payload matches a one item list in the record.
+        if isinstance(value, list) and desired_value is not None and not isinstance(desired_value, (list, tuple, set)):
+            desired_value = [desired_value]
+        if normalize(value) != normalize(desired_value):
+            changes[field] = (value, desired_value)
+    return changes
+
+
+def diff_ids(desired_ids, current_ids):
+    """Returns (ids to remove, ids to add), both sorted, comparing ids as strings."""
+    desired_ids = {str(item) for item in desired_ids}
+    current_ids = {str(item) for item in current_ids}
+    return sorted(current_ids - desired_ids), sorted(desired_ids - current_ids)
+
+
+def format_changes(changes, indent="    "):
+    """Formats the output of diff_fields as one "field: current -> desired" line per field."""
+    return "\n".join(f"{indent}{field}: {current!r} -> {desired!r}" for field, (current, desired) in changes.items())